@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Load generator and latency benchmark for proxy.py.
+
+Starts bench/zotero_stub.py on the Zotero port and proxy.py on the proxy port,
+then drives the proxy with concurrent simulated WPS clients that run "Refresh"
+transactions the way js/zclient.js does. Reports throughput, latency
+percentiles, CPU time and peak RSS of the proxy process. With --baseline the
+run fails when a metric regresses by more than --tolerance. With --replay, a
+session recorded by proxy.py --record is played instead, bench/replay.py
+standing in for Zotero.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from replay import decode_body, load_session
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+PKG_PATH = os.path.dirname(BENCH_PATH)
+PROXY_PORT = 21931
+ZOTERO_PORT = 23119
+
+# Metrics compared against a baseline, and whether a higher value is better
+METRICS = {
+    'throughput': True,
+    'transactions_per_s': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'cpu_ms_per_1k': False,
+    'rss_mb': False,
+}
+
+
+def connect(address, timeout):
+    """Blocking connection to a port on localhost or to a Unix socket path"""
+    if isinstance(address, int):
+        return socket.create_connection(('127.0.0.1', address), timeout=timeout)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(address)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+
+def wait_for_port(address, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connect(address, 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+async def read_response(reader):
+    """Read a response, return (status, headers, body)"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = bytearray()
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                # Trailer
+                while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        body = bytes(body)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+    return status, headers, body
+
+
+class SimulatedClient:
+    """A WPS instance refreshing its document over and over."""
+
+    def __init__(self, index, args, latencies, address=PROXY_PORT):
+        self.doc_id = 'bench-doc-{}'.format(index)
+        self.args = args
+        # Proxy port, or path of its Unix socket
+        self.address = address
+        self.latencies = latencies
+        self.reader = None
+        self.writer = None
+        self.requests = 0
+        self.transactions = 0
+        self.errors = 0
+        self.fields = [{'id': 'field{}'.format(i), 'code': 'ITEM CSL_CITATION {}', 'text': 'citation',
+                        'noteIndex': 0} for i in range(args.fields)]
+
+    async def connect(self):
+        if isinstance(self.address, str):
+            self.reader, self.writer = await asyncio.open_unix_connection(self.address)
+        else:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', PROXY_PORT)
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def exchange(self, data):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(data)
+        status, headers, body = await read_response(self.reader)
+        if self.args.close or headers.get('connection', '').lower() == 'close':
+            self.disconnect()
+        return status, body
+
+    async def post(self, path, payload):
+        status, data = await self.post_body(path, json.dumps(payload).encode('utf8'))
+        return status, json.loads(data) if status < 300 else None
+
+    async def post_body(self, path, body):
+        start = time.perf_counter()
+        if self.args.preflight:
+            await self.exchange(('OPTIONS {} HTTP/1.1\r\nHost: 127.0.0.1:{}\r\nOrigin: null\r\n'
+                                 'Access-Control-Request-Method: POST\r\n'
+                                 'Access-Control-Request-Headers: content-type\r\n\r\n').format(
+                path, PROXY_PORT).encode('latin-1'))
+        head = ('POST {} HTTP/1.1\r\nHost: 127.0.0.1:{}\r\nOrigin: null\r\n'
+                'Content-Type: application/json; charset=utf-8\r\nContent-Length: {}\r\n'
+                'X-Bench-Doc: {}\r\n{}\r\n').format(
+            path, PROXY_PORT, len(body), self.doc_id,
+            'Connection: close\r\n' if self.args.close else '').encode('latin-1')
+        status, data = await self.exchange(head + body)
+        self.latencies.append(time.perf_counter() - start)
+        self.requests += 1
+        return status, data
+
+    def answer(self, command):
+        """What js/zclient.js would respond to a command"""
+        method = command['command'].split('.')[1]
+        if method == 'getActiveDocument':
+            return {'documentID': self.doc_id, 'outputFormat': 'html', 'supportedNotes': ['footnotes'],
+                    'supportsImportExport': True, 'supportsTextInsertion': True,
+                    'supportsCitationMerging': True, 'processorName': 'WPS Office'}
+        if method == 'getDocumentData':
+            return '<data data-version="3"/>'
+        if method == 'getFields':
+            return self.fields
+        if method == 'getText':
+            return 'citation'
+        return None
+
+    async def transact(self):
+        status, command = await self.post('/connector/document/execCommand',
+                                          {'command': 'refresh', 'docId': self.doc_id})
+        path = '/connector/document/batch' if self.args.batch else '/connector/document/respond'
+        while status < 300 and command['command'] != 'Document.complete':
+            status, command = await self.post(path, self.answer(command))
+            if self.args.batch and status < 300:
+                # The proxy answered the others, only the last command needs an answer
+                command = command[-1]
+        if status >= 300:
+            self.errors += 1
+        else:
+            self.transactions += 1
+
+    async def run(self, deadline):
+        while time.monotonic() < deadline:
+            try:
+                await self.transact()
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                self.errors += 1
+                self.disconnect()
+        self.disconnect()
+
+
+class ReplayClient(SimulatedClient):
+    """A WPS instance sending the requests of a recorded session over and over."""
+
+    def __init__(self, index, args, latencies, address, exchanges):
+        super().__init__(index, args, latencies, address)
+        self.requests_sent = [(e['request'].split(' ')[1], decode_body(e['body'])) for e in exchanges
+                              if e['request'].startswith('POST ')]
+
+    async def transact(self):
+        for path, body in self.requests_sent:
+            status, _ = await self.post_body(path, body)
+            if status >= 300:
+                self.errors += 1
+                return
+        self.transactions += 1
+
+
+async def drive(args, address=PROXY_PORT, exchanges=None):
+    latencies = []
+    if exchanges is not None:
+        clients = [ReplayClient(i, args, latencies, address, exchanges) for i in range(args.clients)]
+    else:
+        clients = [SimulatedClient(i, args, latencies, address) for i in range(args.clients)]
+
+    warmup_requests = 0
+    if args.warmup > 0:
+        await asyncio.gather(*(c.run(time.monotonic() + args.warmup) for c in clients))
+        latencies.clear()
+        warmup_requests = sum(c.requests for c in clients)
+        for c in clients:
+            c.requests = c.transactions = c.errors = 0
+
+    start = time.monotonic()
+    await asyncio.gather(*(c.run(start + args.duration) for c in clients))
+    elapsed = time.monotonic() - start
+    requests = sum(c.requests for c in clients)
+    return {
+        'requests': requests,
+        # Including the warmup, the proxy CPU time covers both
+        'total_requests': requests + warmup_requests,
+        'errors': sum(c.errors for c in clients),
+        'throughput': requests / elapsed,
+        'transactions_per_s': sum(c.transactions for c in clients) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0.0) * 1000,
+    }
+
+
+def stop_proxy():
+    try:
+        s = connect(PROXY_PORT, 1.0)
+        s.sendall(b'POST /stopproxy HTTP/1.1\r\nContent-Length: 0\r\n\r\n')
+        s.close()
+    except OSError:
+        pass
+
+
+def run_benchmark(args):
+    env = dict(os.environ)
+    logdir = tempfile.mkdtemp(prefix='wps-zotero-bench-')
+    # Keep the proxy log away from the real one
+    env['HOME'] = logdir
+    env['APPDATA'] = logdir
+    os.makedirs(os.path.join(logdir, 'kingsoft', 'wps', 'jsaddons'), exist_ok=True)
+
+    proxy_args = args.proxy_arg + (['--batch'] if args.batch else [])
+    # Both hops on Unix sockets in the log directory
+    proxy_address = PROXY_PORT
+    zotero_address = ZOTERO_PORT
+    stub_args = []
+    if args.unix:
+        proxy_address = os.path.join(logdir, 'proxy.sock')
+        proxy_args += ['--unix', proxy_address]
+        if not args.external_zotero:
+            zotero_address = os.path.join(logdir, 'zotero.sock')
+            stub_args = ['--unix', zotero_address]
+            proxy_args += ['--zotero-unix', zotero_address]
+
+    stub = None
+    exchanges = None
+    if args.replay:
+        exchanges = load_session(args.replay)
+        if not exchanges:
+            raise RuntimeError('no exchanges in {}'.format(args.replay))
+    if not args.external_zotero:
+        if args.replay:
+            stub_command = [os.path.join(BENCH_PATH, 'replay.py'), args.replay, '--scale', str(args.replay_scale)]
+        else:
+            stub_command = [os.path.join(BENCH_PATH, 'zotero_stub.py'), '--fields', str(args.fields),
+                            '--payload', str(args.payload), '--delay', str(args.delay)]
+        stub = subprocess.Popen([sys.executable] + stub_command + stub_args, stdout=subprocess.DEVNULL)
+        if not wait_for_port(zotero_address):
+            stub.kill()
+            raise RuntimeError('Zotero stub did not start, is port {} in use?'.format(ZOTERO_PORT))
+
+    proxy = subprocess.Popen([sys.executable, os.path.join(PKG_PATH, 'proxy.py')] + proxy_args,
+                             stdout=subprocess.DEVNULL, env=env)
+    try:
+        if not wait_for_port(proxy_address):
+            raise RuntimeError('proxy did not start, is port {} in use?'.format(PROXY_PORT))
+        results = asyncio.run(drive(args, proxy_address, exchanges))
+    finally:
+        stop_proxy()
+        try:
+            proxy.wait(5.0)
+        except subprocess.TimeoutExpired:
+            proxy.kill()
+            proxy.wait()
+        # The proxy is the only child reaped so far, so its usage is all there is
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = usage.ru_utime + usage.ru_stime
+            # Kilobytes on Linux, bytes on macOS
+            rss = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+        if stub is not None:
+            stub.terminate()
+            stub.wait()
+
+    if resource is not None:
+        results['cpu_s'] = cpu
+        results['cpu_ms_per_1k'] = cpu * 1000.0 / max(1, results['total_requests']) * 1000.0
+        results['rss_mb'] = rss
+    results['config'] = {
+        'clients': args.clients, 'duration': args.duration, 'fields': args.fields,
+        'payload': args.payload, 'delay': args.delay, 'preflight': args.preflight,
+        'close': args.close, 'batch': args.batch, 'unix': args.unix, 'proxy_args': args.proxy_arg,
+        'replay': args.replay, 'replay_scale': args.replay_scale,
+    }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the comparison with a baseline, return the names of regressed metrics"""
+    regressions = []
+    print('{:<16}{:>12}{:>12}{:>10}'.format('metric', 'baseline', 'current', 'change'))
+    for name, higher_is_better in METRICS.items():
+        if name not in results or name not in baseline or not baseline[name]:
+            continue
+        change = (results[name] - baseline[name]) / baseline[name]
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        print('{:<16}{:>12.2f}{:>12.2f}{:>+9.1f}%{}'.format(
+            name, baseline[name], results[name], change * 100, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clients', type=int, default=10, help='concurrent simulated WPS clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of measured load')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds of unmeasured load first')
+    parser.add_argument('--fields', type=int, default=50, help='citations per document')
+    parser.add_argument('--payload', type=int, default=512, help='bytes of rich text per citation')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds Zotero takes per command')
+    parser.add_argument('--preflight', action='store_true', help='send a CORS preflight before each request')
+    parser.add_argument('--close', action='store_true', help='open a new connection for every request')
+    parser.add_argument('--batch', action='store_true', help='respond through the batch endpoint of proxy.py --batch')
+    parser.add_argument('--unix', action='store_true',
+                        help='connect to the proxy, and the proxy to the stub, over Unix sockets')
+    parser.add_argument('--replay', help='play this session recorded by proxy.py --record')
+    parser.add_argument('--replay-scale', type=float, default=0.0,
+                        help='factor applied to the recorded time Zotero took to answer (default 0, at once)')
+    parser.add_argument('--proxy-arg', action='append', default=[], help='extra argument for proxy.py, repeatable')
+    parser.add_argument('--external-zotero', action='store_true', help='use whatever listens on the Zotero port')
+    parser.add_argument('--json', help='write the results to this file, usable as a baseline')
+    parser.add_argument('--baseline', help='compare with this baseline and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed relative regression')
+    args = parser.parse_args(argv[1:])
+
+    results = run_benchmark(args)
+
+    print('requests    {requests} ({errors} errors)'.format(**results))
+    print('throughput  {:.1f} req/s, {:.1f} transactions/s'.format(results['throughput'], results['transactions_per_s']))
+    print('latency     p50 {p50_ms:.2f} ms  p95 {p95_ms:.2f} ms  p99 {p99_ms:.2f} ms  max {max_ms:.2f} ms'.format(**results))
+    if 'cpu_s' in results:
+        print('proxy       cpu {cpu_s:.2f} s ({cpu_ms_per_1k:.1f} ms per 1k requests)  rss {rss_mb:.1f} MB'.format(**results))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressed: {}'.format(', '.join(regressions)))
+            return 1
+    return 1 if results['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
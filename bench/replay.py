@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Serves sessions recorded with `proxy.py --record DIR` in place of Zotero.
+
+Every exchange of the session is answered with the recorded status, headers
+and body, after the time Zotero took to answer it (times --scale). Requests
+are matched to exchanges by method and path in recorded order, so a replay
+is deterministic, and start over from the first one once the session is
+exhausted. Clients sending an X-Bench-Doc header, like bench.py --replay,
+each get their own pass over the session.
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import sys
+import zlib
+
+
+ZOTERO_PORT = 23119
+# Recorded headers that depend on how the response is sent, set again when replaying
+FRAMING_HEADERS = ('content-length', 'transfer-encoding', 'connection', 'keep-alive')
+
+
+def load_session(path):
+    """Exchanges of a session file, in recorded order"""
+    exchanges = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf8') as f:
+            for line in f:
+                exchanges.append(json.loads(line))
+    except (EOFError, zlib.error):
+        # Written by a proxy that was killed, the lines read so far are whole
+        pass
+    return exchanges
+
+
+def decode_body(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    return value.encode('utf8')
+
+
+class ReplayServer:
+
+    def __init__(self, exchanges, port=ZOTERO_PORT, scale=1.0, path=None):
+        self.port = port
+        # Unix socket listened on instead of the port
+        self.path = path
+        self.scale = scale
+        # (method, path) -> recorded exchanges
+        self.exchanges = {}
+        for exchange in exchanges:
+            method, target = exchange['request'].split(' ')[:2]
+            self.exchanges.setdefault((method, target), []).append(exchange)
+        # (client, method, path) -> index of the next exchange
+        self.positions = {}
+
+    def next_exchange(self, method, path, client=''):
+        exchanges = self.exchanges.get((method, path))
+        if not exchanges:
+            return None
+        key = (client, method, path)
+        position = self.positions.get(key, 0)
+        self.positions[key] = position + 1
+        return exchanges[position % len(exchanges)]
+
+    async def read_body(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                        pass
+                    return
+                await reader.readexactly(size + 2)
+        await reader.readexactly(int(headers.get('content-length', 0)))
+
+    async def on_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                method, path = lines[0].split(' ')[:2]
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+                await self.read_body(reader, headers)
+
+                exchange = self.next_exchange(method, path, headers.get('x-bench-doc', ''))
+                close = headers.get('connection', '').lower() == 'close'
+                if exchange is None:
+                    status, fields, body = 'HTTP/1.1 404 Not Found', [['Content-Type', 'text/plain']], b'Not recorded'
+                else:
+                    if self.scale > 0:
+                        await asyncio.sleep(exchange['wait'] * self.scale)
+                    status = exchange['status']
+                    fields = [f for f in exchange['response_headers'] if f[0].lower() not in FRAMING_HEADERS]
+                    body = decode_body(exchange['response_body'])
+                fields += [['Content-Length', str(len(body))], ['Connection', 'close' if close else 'keep-alive']]
+                writer.write((status + '\r\n' + ''.join('{}: {}\r\n'.format(k, v) for k, v in fields)
+                              + '\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if close:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        if self.path:
+            server = await asyncio.start_unix_server(self.on_client, self.path)
+        else:
+            server = await asyncio.start_server(self.on_client, '127.0.0.1', self.port)
+        if ready is not None:
+            ready()
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve(lambda: print('Replaying {} exchanges on {}'.format(
+                sum(len(e) for e in self.exchanges.values()), self.path or self.port), flush=True)))
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('session', help='session file written by proxy.py --record')
+    parser.add_argument('--port', type=int, default=ZOTERO_PORT)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='factor applied to the recorded time Zotero took to answer, 0 to answer at once')
+    parser.add_argument('--unix', help='listen on this Unix socket instead of the port')
+    args = parser.parse_args(argv[1:])
+    exchanges = load_session(args.session)
+    if not exchanges:
+        print('No exchanges in {}'.format(args.session))
+        return 1
+    ReplayServer(exchanges, args.port, args.scale, args.unix).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the Zotero connector server, for benchmarking proxy.py.
+
+It speaks the HTTP integration protocol used by js/zclient.js: a POST to
+/connector/document/execCommand starts a transaction and every POST to
+/connector/document/respond returns the next word processor command, until
+Document.complete. The command script mimics a "Refresh" of a document with
+a given number of citations.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+
+
+ZOTERO_PORT = 23119
+FIELDS = 50
+PAYLOAD = 512  # Bytes of rich text per citation
+VERSION = '7.0.0'
+
+
+def session_commands(doc_id, fields, payload):
+    """Commands sent by Zotero to refresh a document with the given number of citations"""
+    text = '<span>' + 'x' * max(0, payload - 13) + '</span>'
+    commands = [
+        ('Document.getActiveDocument', []),
+        ('Document.getDocumentData', [doc_id]),
+        ('Document.setDocumentData', [doc_id, '<data data-version="3"/>']),
+        ('Document.getFields', [doc_id, 'Http']),
+    ]
+    for i in range(fields):
+        field_id = 'field{}'.format(i)
+        commands.append(('Field.getText', [doc_id, field_id]))
+        commands.append(('Field.setText', [doc_id, field_id, text, True]))
+        commands.append(('Field.setCode', [doc_id, field_id, 'ITEM CSL_CITATION {}']))
+    commands.append(('Document.setBibliographyStyle', [doc_id, 0, 720, 240, 0, [], 0]))
+    commands.append(('Document.complete', [doc_id]))
+    return commands
+
+
+class ZoteroStub:
+
+    def __init__(self, port=ZOTERO_PORT, fields=FIELDS, payload=PAYLOAD, delay=0.0, path=None):
+        self.port = port
+        # Unix socket listened on instead of the port
+        self.path = path
+        self.fields = fields
+        self.payload = payload
+        self.delay = delay
+        self.sessions = {}
+        self.last_session = None
+
+    def command(self, doc_id):
+        commands = self.sessions.get(doc_id)
+        if not commands:
+            return {'command': 'Document.complete', 'arguments': [doc_id]}
+        name, args = commands.pop(0)
+        if name == 'Document.complete':
+            del self.sessions[doc_id]
+        return {'command': name, 'arguments': args}
+
+    def respond(self, path, body, doc_id=None):
+        """Return (status, content type, body) for a request"""
+        if path == '/connector/ping':
+            return 200, 'text/html', b'Zotero is running'
+
+        if path == '/connector/document/execCommand':
+            request = json.loads(body)
+            doc_id = request['docId']
+            self.sessions[doc_id] = session_commands(doc_id, self.fields, self.payload)
+            self.last_session = doc_id
+            return 200, 'application/json', json.dumps(self.command(doc_id)).encode('utf8')
+
+        if path == '/connector/document/respond':
+            # Zotero keeps one integration session at a time, concurrent benchmark
+            # clients tell theirs apart with a header.
+            doc_id = doc_id or self.last_session
+            if doc_id is None:
+                return 400, 'text/plain', b'No active session'
+            return 200, 'application/json', json.dumps(self.command(doc_id)).encode('utf8')
+
+        return 404, 'text/plain', b'Not found'
+
+    async def on_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                method, path = lines[0].split(' ')[:2]
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                status, content_type, data = self.respond(path, body, headers.get('x-bench-doc'))
+                close = headers.get('connection', '').lower() == 'close'
+                writer.write(('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                              'X-Zotero-Version: {}\r\nConnection: {}\r\n\r\n').format(
+                    status, 'OK' if status == 200 else 'Error', content_type, len(data),
+                    VERSION, 'close' if close else 'keep-alive').encode('latin-1') + data)
+                await writer.drain()
+                if close:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        if self.path:
+            server = await asyncio.start_unix_server(self.on_client, self.path)
+        else:
+            server = await asyncio.start_server(self.on_client, '127.0.0.1', self.port)
+        if ready is not None:
+            ready()
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve(lambda: print('Zotero stub listening on {}'.format(self.path or self.port),
+                                                 flush=True)))
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=ZOTERO_PORT)
+    parser.add_argument('--fields', type=int, default=FIELDS, help='citations per document')
+    parser.add_argument('--payload', type=int, default=PAYLOAD, help='bytes of rich text per citation')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds Zotero takes per command')
+    parser.add_argument('--unix', help='listen on this Unix socket instead of the port')
+    args = parser.parse_args(argv[1:])
+    ZoteroStub(args.port, args.fields, args.payload, args.delay, args.unix).run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
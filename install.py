@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import errno
+import hashlib
+import json
 import os
 import platform
 import shutil
@@ -7,7 +10,8 @@ import sys
 import re
 import stat
 import subprocess 
-from proxy import stop_proxy
+import tempfile
+from proxy import PROXY_PORT, stop_proxy
 
 
 # Prevent running as root on Linux
@@ -106,14 +110,75 @@ XML_PATHS = {
     'authwebsite': ADDON_PATH + os.path.sep + 'authwebsite.xml'
 }
 PROXY_PATH = ADDON_PATH + os.path.sep + 'proxy.py'
+# Files and directories of the checkout the add-on needs at runtime, the rest is not installed
+RUNTIME_FILES = ['index.html', 'main.js', 'ribbon.xml', 'version.js', 'proxy.py', 'LICENSE.txt', 'js', 'images']
+# Written in the installed directory: relative path -> SHA-256 of every installed file
+MANIFEST_NAME = 'manifest.json'
+SYSTEMD_USER_PATH = os.path.join(os.environ.get('HOME', ''), '.config', 'systemd', 'user')
+SYSTEMD_UNIT = 'wps-zotero-proxy'
+# Seconds without clients after which the socket-activated proxy exits
+IDLE_EXIT = 600
+# renameat2() flag swapping two paths in one step (Linux 3.15)
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def has_systemd_user():
+    """Whether a systemd user instance is running to activate the proxy"""
+    if shutil.which('systemctl') is None:
+        return False
+    p = subprocess.run(['systemctl', '--user', 'is-system-running'],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # Exits with 1 both when degraded, which still runs units, and when there is no instance
+    return p.stdout.decode().strip() in ('running', 'degraded', 'starting')
+
+
+def install_socket_unit(addon_dir, python_path, start=True):
+    """Have systemd listen on the proxy port and start the proxy on the first connection.
+
+    With start, a running proxy is stopped so that the next connection starts the
+    installed one.
+    """
+    os.makedirs(SYSTEMD_USER_PATH, exist_ok=True)
+    with open(os.path.join(SYSTEMD_USER_PATH, SYSTEMD_UNIT + '.socket'), 'w') as f:
+        f.write(f'''[Unit]
+Description=WPS Zotero Proxy socket
+
+[Socket]
+ListenStream=127.0.0.1:{PROXY_PORT}
+
+[Install]
+WantedBy=sockets.target
+''')
+    # Run as a module so that its cached bytecode is used, the proxy answers sooner
+    with open(os.path.join(SYSTEMD_USER_PATH, SYSTEMD_UNIT + '.service'), 'w') as f:
+        f.write(f'''[Unit]
+Description=WPS Zotero Proxy
+Requires={SYSTEMD_UNIT}.socket
+
+[Service]
+WorkingDirectory={addon_dir}
+ExecStart="{python_path}" -m proxy --persistent --idle-exit {IDLE_EXIT}
+''')
+    subprocess.run(['systemctl', '--user', 'daemon-reload'])
+    if start:
+        subprocess.run(['systemctl', '--user', 'stop', SYSTEMD_UNIT + '.service'], stderr=subprocess.DEVNULL)
+        subprocess.run(['systemctl', '--user', 'enable', '--now', SYSTEMD_UNIT + '.socket'])
+    else:
+        subprocess.run(['systemctl', '--user', 'enable', SYSTEMD_UNIT + '.socket'])
+    print(f"Created systemd user units: {SYSTEMD_USER_PATH}/{SYSTEMD_UNIT}.{{socket,service}}")
 
 
-def install_startup_service(addon_dir, python_path):
+def install_startup_service(addon_dir, python_path, start=True):
+    """Start the proxy at login from addon_dir, and now unless start is false"""
     print("Installing background service for automatic startup...")
 
     proxy_script = os.path.join(addon_dir, 'proxy.py')
 
-    if platform.system() == 'Linux':
+    if platform.system() == 'Linux' and has_systemd_user():
+        install_socket_unit(addon_dir, python_path, start)
+
+    elif platform.system() == 'Linux':
         autostart_dir = os.path.join(os.environ['HOME'], '.config', 'autostart')
         if not os.path.exists(autostart_dir):
             os.makedirs(autostart_dir, exist_ok=True)
@@ -132,8 +197,9 @@ Comment=Proxy server for WPS Zotero integration
         print(f"Created autostart entry: {desktop_file}")
 
         # Start it now
-        subprocess.Popen([python_path, proxy_script, '--persistent'],
-                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if start:
+            subprocess.Popen([python_path, proxy_script, '--persistent'],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     elif platform.system() == 'Darwin':
         # MacOS LaunchAgent
@@ -164,10 +230,11 @@ Comment=Proxy server for WPS Zotero integration
 ''')
         print(f"Created LaunchAgent: {plist_path}")
 
-        # Load it now
+        # Load it now, which restarts the proxy it keeps alive
         try:
-            subprocess.run(['launchctl', 'unload', plist_path], stderr=subprocess.DEVNULL)
-            subprocess.run(['launchctl', 'load', plist_path], stderr=subprocess.DEVNULL)
+            if start:
+                subprocess.run(['launchctl', 'unload', plist_path], stderr=subprocess.DEVNULL)
+                subprocess.run(['launchctl', 'load', plist_path], stderr=subprocess.DEVNULL)
         except Exception as e:
             print(f"Failed to load LaunchAgent: {e}")
 
@@ -198,13 +265,29 @@ Comment=Proxy server for WPS Zotero integration
 
         # Start it now
         try:
-            subprocess.Popen(['wscript', vbs_path], shell=False)
+            if start:
+                subprocess.Popen(['wscript', vbs_path], shell=False)
         except Exception as e:
             print(f"Failed to start proxy immediately: {e}")
 
 
 def remove_startup_service():
     if platform.system() == 'Linux':
+        units = [os.path.join(SYSTEMD_USER_PATH, SYSTEMD_UNIT + ext) for ext in ('.socket', '.service')]
+        if any(os.path.exists(unit) for unit in units):
+            try:
+                subprocess.run(['systemctl', '--user', 'disable', '--now',
+                                SYSTEMD_UNIT + '.socket', SYSTEMD_UNIT + '.service'], stderr=subprocess.DEVNULL)
+            except Exception as e:
+                print(f"Failed to disable systemd units: {e}")
+            for unit in units:
+                if os.path.exists(unit):
+                    print(f"Removing {unit}")
+                    os.remove(unit)
+            try:
+                subprocess.run(['systemctl', '--user', 'daemon-reload'], stderr=subprocess.DEVNULL)
+            except Exception as e:
+                print(f"Failed to reload systemd units: {e}")
         desktop_file = os.path.join(os.environ['HOME'], '.config', 'autostart', 'wps-zotero-proxy.desktop')
         if os.path.exists(desktop_file):
             print(f"Removing {desktop_file}")
@@ -227,23 +310,21 @@ def remove_startup_service():
             os.remove(vbs_path)
 
 
-def uninstall():
-    print("Trying to quit proxy server if it's currently listening...")
-    stop_proxy()
-    remove_startup_service()
-    
-    def del_rw(action, name, exc):
-        os.chmod(name, stat.S_IWRITE)
-        os.remove(name)
+def del_rw(action, name, exc):
+    os.chmod(name, stat.S_IWRITE)
+    os.remove(name)
 
-    if not os.path.isdir(ADDON_PATH):
-        return
 
+def remove_addon_dirs(keep=None):
+    """Remove the installed add-on directories, but the one named keep"""
     for x in os.listdir(ADDON_PATH):
-        if os.path.isdir(ADDON_PATH + os.path.sep + x) and 'wps-zotero' in x:
+        if os.path.isdir(ADDON_PATH + os.path.sep + x) and 'wps-zotero' in x and x != keep:
             print('Removing {}'.format(ADDON_PATH + os.path.sep + x))
             shutil.rmtree(ADDON_PATH + os.path.sep + x, onerror=del_rw)
 
+
+def unregister():
+    """Remove the add-on's records from WPS's XML files"""
     for fp in XML_PATHS.values():
         if not os.path.isfile(fp):
             continue
@@ -260,10 +341,138 @@ def uninstall():
             f.write(xmlStr)
 
 
-# Uninstall existing installation
-print('Uninstalling previous installations if there is any ...')
-uninstall()
+def uninstall():
+    print("Trying to quit proxy server if it's currently listening...")
+    stop_proxy()
+    remove_startup_service()
+
+    if not os.path.isdir(ADDON_PATH):
+        return
+
+    remove_addon_dirs()
+    unregister()
+
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def runtime_files(config):
+    """Relative path (with / separators) -> content of every file to install"""
+    files = {}
+    for name in RUNTIME_FILES:
+        path = os.path.join(PKG_PATH, name)
+        paths = [path]
+        if os.path.isdir(path):
+            paths = sorted(os.path.join(root, n) for root, _, names in os.walk(path) for n in names)
+        for p in paths:
+            with open(p, 'rb') as f:
+                files[os.path.relpath(p, PKG_PATH).replace(os.path.sep, '/')] = f.read()
+    # Generated for this host in place of the checkout's
+    files['js/config.js'] = config.encode('utf8')
+    return files
+
+
+def installed_manifest():
+    """(directory name, manifest) of the current installation, the one of this version first.
+
+    The manifest is empty for an installation made before manifests were written.
+    """
+    if not os.path.isdir(ADDON_PATH):
+        return None, {}
+    names = sorted(x for x in os.listdir(ADDON_PATH)
+                   if x.startswith('wps-zotero') and os.path.isdir(os.path.join(ADDON_PATH, x)))
+    if not names:
+        return None, {}
+    name = APPNAME if APPNAME in names else names[-1]
+    try:
+        with open(os.path.join(ADDON_PATH, name, MANIFEST_NAME)) as f:
+            return name, json.load(f)
+    except (OSError, ValueError):
+        return name, {}
+
+
+def stage(files, manifest, previous, previous_manifest):
+    """Write the files to a new directory next to the installed ones, return its path.
+
+    Files unchanged since the previous installation are hard links to its copies,
+    the others are written with the mode of the checkout's.
+    """
+    staging = tempfile.mkdtemp(prefix='.{}.'.format(APPNAME), dir=ADDON_PATH)
+    try:
+        # mkdtemp() makes it private to the user
+        os.chmod(staging, 0o755)
+        for name, data in files.items():
+            path = os.path.join(staging, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if previous is not None and previous_manifest.get(name) == manifest[name]:
+                try:
+                    os.link(os.path.join(ADDON_PATH, previous, *name.split('/')), path)
+                    continue
+                except OSError:
+                    pass
+            with open(path, 'wb') as f:
+                f.write(data)
+            source = os.path.join(PKG_PATH, *name.split('/'))
+            if os.path.exists(source):
+                # proxy.py stays executable
+                shutil.copymode(source, path)
+        with open(os.path.join(staging, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    except BaseException:
+        shutil.rmtree(staging, onerror=del_rw)
+        raise
+    return staging
+
+
+def exchange(a, b):
+    """Swap two existing paths atomically, return False where the system cannot"""
+    if platform.system() != 'Linux':
+        return False
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    # glibc 2.28 and later
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 is None:
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    if renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    # Kernel or file system without RENAME_EXCHANGE
+    if err in (errno.ENOSYS, errno.EINVAL):
+        return False
+    raise OSError(err, os.strerror(err), a, None, b)
+
+
+def swap(staging, target):
+    """Put the staged directory in place of target.
+
+    On Linux the two are exchanged in one step, WPS finds either the old add-on or the
+    new one. Elsewhere target is renamed away first, and missing until staging takes its place.
+    """
+    if os.path.exists(target) and exchange(staging, target):
+        # Holds the previous installation now
+        shutil.rmtree(staging, onerror=del_rw)
+        return
+    old = None
+    if os.path.exists(target):
+        old = staging + '.old'
+        os.rename(target, old)
+    try:
+        os.rename(staging, target)
+    except OSError:
+        if old is not None:
+            os.rename(old, target)
+        shutil.rmtree(staging, onerror=del_rw)
+        raise
+    if old is not None:
+        shutil.rmtree(old, onerror=del_rw)
+
+
 if len(sys.argv) > 1 and sys.argv[1] == '-u':
+    print('Uninstalling ...')
+    uninstall()
     sys.exit()
 
 
@@ -293,18 +502,25 @@ if not os.path.exists(XML_PATHS['authwebsite']):
 ''')
 
 
-# Copy to jsaddons
+# Copy to jsaddons, only the files that changed since the previous installation
 target_dir = ADDON_PATH + os.path.sep + APPNAME
-shutil.copytree(PKG_PATH, target_dir)
-
-# Create/Update config.js in the installed directory
-config_path = os.path.join(target_dir, 'js', 'config.js')
-with open(config_path, 'w') as f:
-    f.write('// This file is automatically generated by install.py\n')
-    f.write(f'const PYTHON_PATH = "{PYTHON_PATH}";\n')
-    # Escape backslashes for JS string
-    addon_path_js = ADDON_PATH.replace('\\', '\\\\')
-    f.write(f'const ADDON_PATH = "{addon_path_js}";\n')
+# config.js is generated for this host
+# Escape backslashes for JS string
+addon_path_js = ADDON_PATH.replace('\\', '\\\\')
+config = ('// This file is automatically generated by install.py\n'
+          f'const PYTHON_PATH = "{PYTHON_PATH}";\n'
+          f'const ADDON_PATH = "{addon_path_js}";\n')
+files = runtime_files(config)
+manifest = {name: file_hash(data) for name, data in files.items()}
+previous, previous_manifest = installed_manifest()
+changed = sorted(name for name in manifest if previous_manifest.get(name) != manifest[name])
+if previous == APPNAME and not changed and set(previous_manifest) == set(manifest):
+    print('Add-on files are up to date')
+else:
+    print('Updating {} of {} files'.format(len(changed), len(manifest)))
+    swap(stage(files, manifest, previous, previous_manifest), target_dir)
+# Older versions, and what an interrupted installation left behind
+remove_addon_dirs(keep=APPNAME)
 
 
 # Write records to XML files
@@ -331,6 +547,9 @@ def register(fp, tagname, record):
     with open(fp, 'w') as f:
         f.write(content[:i] + record + os.linesep + content[i:])
 
+if previous != APPNAME:
+    # The records name the version
+    unregister()
 rec = '<jsplugin name="wps-zotero" type="wps" url="http://127.0.0.1:3889/" version="{}"/>'.format(VERSION)
 register(XML_PATHS['jsplugins'], 'jsplugins', rec)
 rec = '<jsplugin url="http://127.0.0.1:3889/" type="wps" enable="enable_dev" install="null" version="{}" name="wps-zotero"/>'.format(VERSION)
@@ -361,9 +580,16 @@ if os.name == 'nt':
     except Exception as e:
         print(f"Failed to update Zotero prefs: {e}")
 
-# Install Startup Service
+# Install Startup Service, restart the proxy only if it changed
 try:
-    install_startup_service(target_dir, PYTHON_PATH.replace('\\\\', '\\'))
+    if 'proxy.py' in changed:
+        print("Trying to quit proxy server if it's currently listening...")
+        stop_proxy()
+        remove_startup_service()
+        install_startup_service(target_dir, PYTHON_PATH.replace('\\\\', '\\'))
+    elif previous != APPNAME or 'js/config.js' in changed:
+        # Moved or run by another Python, the running proxy is left alone
+        install_startup_service(target_dir, PYTHON_PATH.replace('\\\\', '\\'), start=False)
 except Exception as e:
     print(f"Failed to install startup service: {e}")
 
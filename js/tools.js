@@ -42,7 +42,7 @@ function postRequestXHR(url, payload) {
     catch (error) {
         // Swallow any errors
     }
-    const ret = { status: req.status, payload: json };
+    const ret = { status: req.status, payload: json, header: name => req.getResponseHeader(name) };
     console.debug('<<<<< response: ', ret);
     return ret;
 }
@@ -13,6 +13,13 @@ function zc_createClient(documentId, processor) {
     // The proxy server listens on 21931 and forwards requests to 23119
     const commandUrl = 'http://127.0.0.1:21931/connector/document/execCommand';
     const respondUrl = 'http://127.0.0.1:21931/connector/document/respond';
+    // Served by the proxy when started with --batch, see proxy.py
+    const batchUrl = 'http://127.0.0.1:21931/connector/document/batch';
+    // Set by the proxy on the response to execCommand when it serves the batch endpoint
+    const batchHeader = 'X-WPS-Zotero-Batch';
+    let useBatch = false;
+    // Set while carrying out commands the proxy has already answered
+    let acknowledged = false;
 
     function requestStatusHint(status) {
         if (status >= 300) {
@@ -34,16 +41,49 @@ function zc_createClient(documentId, processor) {
     }
 
     function execCommand(command) {
-        return postRequestXHR(commandUrl, {
+        const req = postRequestXHR(commandUrl, {
             "command": command,
             "docId": documentId,
-        })
+        });
+        useBatch = req.header(batchHeader) === '1';
+        return req;
     }
 
     function respond(payload) {
+        if (acknowledged) {
+            return null;
+        }
+        if (useBatch) {
+            return runBatch(postRequestXHR(batchUrl, payload));
+        }
         return postRequestXHR(respondUrl, payload);
     }
 
+    /**
+     * Carry out the commands of a batch response. The proxy has answered all but the
+     * last one, which is returned to be answered like a response to respond.
+    **/
+    function runBatch(req) {
+        if (!Array.isArray(req.payload)) {
+            return req;
+        }
+        const commands = req.payload;
+        const last = req.status < 300 ? commands.pop() : undefined;
+        acknowledged = true;
+        try {
+            for (const command of commands) {
+                autoRespond({ status: 200, payload: command });
+            }
+        }
+        finally {
+            acknowledged = false;
+        }
+        if (last === undefined) {
+            return { status: req.status >= 300 ? req.status : 500, payload: undefined };
+        }
+        return { status: req.status, payload: last };
+    }
+
     /**
      * Send command to Zotero and make changes to documents.
     **/
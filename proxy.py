@@ -1,165 +1,1998 @@
 #!/usr/bin/env python3
 
+import base64
+import bisect
+import heapq
+import itertools
+import json
+import math
+import queue
+import re
 import socket
-import select
+import selectors
+import stat
+import struct
 import sys
 import logging
+import logging.handlers
 import os
+import signal
+import threading
 import atexit
 import traceback
 import errno
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # Optional, br is only offered when it is installed
+    brotli = None
+
+# Imported by AsyncProxyServer, so that the selectors engine starts without it
+asyncio = None
+
+# Debug messages of the proxy, the only ones --log-sample turns on
+log = logging.getLogger('wps-zotero-proxy')
 
 
 ZOTERO_PORT = 23119
 PROXY_PORT = 21931
-BUFSIZE = 8192
+BUFSIZE = 65536
+MAX_HEAD_SIZE = 65536
+RETRY_BUFFER_LIMIT = 65536  # Largest request kept to retry on a stale pooled connection
 DELAY = 0.0001
 SOCKET_TIMEOUT = 5.0  # Seconds
+POOL_MAX_SIZE = 4  # Idle keep-alive connections to Zotero, 0 to disable
+POOL_IDLE_TIMEOUT = 30.0  # Seconds
+KEEP_ALIVE_TIMEOUT = 60.0  # Seconds an idle client connection is kept open
+CONNECT_TIMEOUT = 5.0  # Seconds to connect to Zotero
+HEADER_TIMEOUT = 10.0  # Seconds to receive a whole message head once it has started
+READ_TIMEOUT = 5.0  # Seconds without progress while receiving a message body or sending data
+MAX_CONNECTIONS = 256  # Client connections served at once, 0 for no limit
+RATE_LIMIT = 0.0  # Requests per second forwarded for each client, 0 for no limit
+RATE_BURST = 20  # Requests a client may send at once before its rate is limited
+MAX_BUFFER = 1024 * 1024  # Bytes queued for a slow side before reading from the other side pauses
+# Unix socket family, None where the platform has none (Windows)
+AF_UNIX = getattr(socket, 'AF_UNIX', None)
+UNIX_SOCKET_MODE = 0o600  # Permissions of the --unix socket, only its owner may connect
+WORKER_RESTART_DELAY = 1.0  # Seconds before restarting a worker that crashed right after starting
+LISTEN_FDS_START = 3  # First file descriptor passed by systemd socket activation
+IDLE_EXIT = 0.0  # Seconds without clients after which the proxy exits, 0 to keep running
+ZOTERO_DOWN_TTL = 1.0  # Seconds requests fail fast after Zotero could not be reached
+PROBE_INTERVAL = 10.0  # Seconds between checks that Zotero answers, 0 to disable them
+PROBE_MAX_INTERVAL = 60.0  # Longest interval between checks while Zotero is down and not asked for
+CONNECTOR_PING_PATH = '/connector/ping'
 PREFLIGHT_HEADERS = {
     'Access-Control-Allow-Origin': '*',
     'Access-Control-Allow-Methods': 'GET,POST,OPTIONS,PUT,PATCH,DELETE',
     'Access-Control-Allow-Headers': '*',
     'Access-Control-Allow-Credentials': 'true',
 }
+ZOTERO_NOT_RUNNING = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n'
+                      b'Content-Length: 22\r\nConnection: close\r\n\r\nZotero is not running.')
+USER_NOT_MAPPED = (b'HTTP/1.1 403 Forbidden\r\nContent-Type: text/plain\r\n'
+                   b'Content-Length: 36\r\nConnection: close\r\n\r\nNo Zotero port is set for this user.')
+TOO_MANY_CONNECTIONS = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\nRetry-After: 1\r\n'
+                        b'Content-Length: 30\r\nConnection: close\r\n\r\nToo many connections to proxy.')
+PREFLIGHT_MAX_AGE = 600  # Seconds the client may reuse a preflight result
+PREFLIGHT_CACHE_SIZE = 64
+METRICS_PATH = '/__metrics'
+HEALTH_PATH = '/__health'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)  # Bytes
+TRACE_CAPTURE_SIZE = 4096  # Leading body bytes searched for the command and document ID
+TRACE_FORMATS = ('chrome', 'otlp')
+TRACE_COMMAND = re.compile(rb'"command"\s*:\s*"([^"]*)"')
+TRACE_DOC_ID = re.compile(rb'"docId"\s*:\s*"([^"]*)"')
+RECORD_BODY_LIMIT = 4 * 1024 * 1024  # Bytes of each body kept in a recorded session
+RECORD_FLUSH_INTERVAL = 1.0  # Seconds between flushes of the session file
+BATCH_PATH = '/connector/document/batch'
+RESPOND_PATH = '/connector/document/respond'
+EXEC_PATH = '/connector/document/execCommand'
+BATCH_HEADER = 'X-WPS-Zotero-Batch'  # Set on execCommand responses when BATCH_PATH is served
+RESPONSE_CACHE_SIZE = 4 * 1024 * 1024  # Bytes of responses kept by --cache
+RESPONSE_CACHE_TTLS = {'/connector/ping': 5.0}  # Seconds GET responses are cached for, by path
+# Integration commands change the document or Zotero's state, never answered from the cache
+UNCACHEABLE_PATHS = (EXEC_PATH, RESPOND_PATH, BATCH_PATH)
+# Word processor commands always answered with null, see the responders in js/zclient.js.
+# In batch mode the proxy acknowledges them itself and WPS carries them out afterwards.
+VOID_COMMANDS = frozenset(('activate', 'setDocumentData', 'insertText', 'convert', 'setBibliographyStyle',
+                           'delete', 'select', 'removeCode', 'setText', 'setCode'))
+LOG_MAX_BYTES = 1024 * 1024
+LOG_ROTATE_INTERVAL = 24 * 3600  # Seconds
+LOG_BACKUP_COUNT = 5  # Compressed archives kept
+LOG_FORMATS = ('text', 'json')
+COMPRESS_LEVEL = 6  # 1-9, brotli also takes 10 and 11
+COMPRESS_MIN_SIZE = 1024  # Bytes, responses of a known smaller length are sent as is
+# Content types worth compressing, matched as substrings of the Content-Type header
+COMPRESSIBLE_TYPES = ('text/', 'json', 'javascript', 'xml')
+# Type and help text of the metrics served at METRICS_PATH, in output order
+METRIC_TYPES = {
+    'wps_zotero_requests_total': ('counter', 'Requests answered, by method, connector path and status'),
+    'wps_zotero_request_duration_seconds': ('histogram', 'Time from a request head to the end of its response'),
+    'wps_zotero_upstream_connect_seconds': ('histogram', 'Time taken to connect to Zotero'),
+    'wps_zotero_request_body_bytes': ('histogram', 'Size of forwarded request bodies'),
+    'wps_zotero_response_body_bytes': ('histogram', 'Size of relayed response bodies'),
+    'wps_zotero_active_channels': ('gauge', 'Requests being forwarded to Zotero'),
+    'wps_zotero_client_connections': ('gauge', 'Client connections open'),
+    'wps_zotero_idle_upstream_connections': ('gauge', 'Keep-alive connections to Zotero in the pool'),
+    'wps_zotero_preflight_requests_total': ('counter', 'CORS preflight requests answered by the proxy'),
+    'wps_zotero_preflight_cache_hits_total': ('counter', 'Preflight requests answered from the cache'),
+    'wps_zotero_response_cache_hits_total': ('counter', 'GET requests answered from the response cache'),
+    'wps_zotero_response_cache_bytes': ('gauge', 'Size of the responses in the response cache'),
+    'wps_zotero_batched_commands_total': ('counter', 'Commands acknowledged by the proxy in batch mode'),
+    'wps_zotero_backpressure_pauses_total': ('counter', 'Times reading paused until a slow peer caught up'),
+    'wps_zotero_errors_total': ('counter', 'Errors by category'),
+}
+
+
+# Lowercased header names as bytes, memoized for lookups with str names
+HEADER_KEYS = {}
+
+
+def header_key(name):
+    key = HEADER_KEYS.get(name)
+    if key is None:
+        if isinstance(name, str):
+            key = name.lower().encode('latin-1')
+        else:
+            key = name.lower()
+        HEADER_KEYS[name] = key
+    return key
+
+
+def header_bytes(value):
+    return value.encode('latin-1') if isinstance(value, str) else value
+
+
+class Headers:
+    """Case-insensitive multimap of header fields, kept as received.
+
+    Lookups take str or bytes names and return str values. Duplicate fields are
+    kept in order, and fields that are not modified are serialized back byte for
+    byte.
+    """
+
+    __slots__ = ('fields', 'index')
+
+    def __init__(self):
+        # [name, value] pairs as bytes, in order
+        self.fields = []
+        # Lowercased name -> pairs with that name
+        self.index = {}
+
+    def __contains__(self, name):
+        return header_key(name) in self.index
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        """Replace all fields with this name, in place of the first one"""
+        pairs = self.index.get(header_key(name))
+        if not pairs:
+            self.add(name, value)
+            return
+        pairs[0][1] = header_bytes(value)
+        if len(pairs) > 1:
+            self.remove_pairs(pairs[1:])
+            del pairs[1:]
+
+    def __delitem__(self, name):
+        self.pop(name)
+
+    def get(self, name, default=None):
+        """Value of the first field with this name"""
+        pairs = self.index.get(header_key(name))
+        if not pairs:
+            return default
+        return pairs[0][1].decode('latin-1')
+
+    def get_all(self, name):
+        """Values of all fields with this name"""
+        return [v.decode('latin-1') for _, v in self.index.get(header_key(name), ())]
+
+    def add(self, name, value):
+        pair = [header_bytes(name), header_bytes(value)]
+        self.fields.append(pair)
+        key = header_key(name)
+        pairs = self.index.get(key)
+        if pairs is None:
+            self.index[key] = [pair]
+        else:
+            pairs.append(pair)
+
+    def pop(self, name):
+        pairs = self.index.pop(header_key(name), None)
+        if pairs:
+            self.remove_pairs(pairs)
+
+    def remove_pairs(self, pairs):
+        ids = {id(p) for p in pairs}
+        self.fields = [p for p in self.fields if id(p) not in ids]
+
+    def items(self):
+        return [(k.decode('latin-1'), v.decode('latin-1')) for k, v in self.fields]
+
+    def to_bytes(self):
+        parts = []
+        for k, v in self.fields:
+            parts += (k, b': ', v, b'\r\n')
+        return b''.join(parts)
+
+
+def parse_head(hd_raw):
+    """Parse a raw message head without its final CRLF, return (start_line, Headers)"""
+    lines = hd_raw.split(b'\r\n')
+    headers = Headers()
+    fields = headers.fields
+    index = headers.index
+    for line in lines[1:]:
+        # No whitespace is allowed between the field name and the colon
+        name, sep, value = line.partition(b':')
+        if not sep:
+            continue
+        pair = [name, value.strip()]
+        fields.append(pair)
+        key = name.lower()
+        if key in index:
+            index[key].append(pair)
+        else:
+            index[key] = [pair]
+    # Latin-1 maps every byte, so the start line is serialized back unchanged
+    return lines[0].decode('latin-1'), headers
+
+
+def is_keep_alive(start_line, headers):
+    """Whether the connection may be reused after this message"""
+    tokens = [t.strip().lower() for t in ','.join(headers.get_all('Connection')).split(',')]
+    if 'close' in tokens:
+        return False
+    if start_line.startswith('HTTP/1.0') or start_line.endswith('HTTP/1.0'):
+        return 'keep-alive' in tokens
+    return True
+
+
+def build_head(start_line, headers):
+    """Serialize a message head"""
+    return start_line.encode('latin-1') + b'\r\n' + headers.to_bytes() + b'\r\n'
+
+
+def drop_hop_headers(headers):
+    headers.pop('Connection')
+    headers.pop('Keep-Alive')
+
+
+def is_preflight(request, headers):
+    return request.startswith('OPTIONS') and 'Origin' in headers and 'Access-Control-Request-Method' in headers
+
+
+class PreflightCache:
+    """Prebuilt responses to CORS preflight requests.
+
+    A response only depends on the Origin, Access-Control-Request-Method and
+    Access-Control-Request-Headers of the request, so the same few preflights
+    sent by WPS before each execCommand and respond are formatted once.
+    """
+
+    def __init__(self, max_size=PREFLIGHT_CACHE_SIZE):
+        self.max_size = max_size
+        self.responses = {}
+        self.hits = 0
+
+    def response(self, headers, keep_alive):
+        key = (headers.get('Origin'), headers.get('Access-Control-Request-Method'),
+               headers.get('Access-Control-Request-Headers'), keep_alive)
+        data = self.responses.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        if len(self.responses) >= self.max_size:
+            # Drop the oldest entry
+            del self.responses[next(iter(self.responses))]
+        data = self.responses[key] = preflight_response(key[2], keep_alive)
+        return data
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header lists an entity tag, compared weakly"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag.replace('W/', '', 1) in [tag.replace('W/', '', 1) for tag in tags]
+
+
+class CachedResponse:
+    """A response of Zotero kept by ResponseCache, filled while it is relayed."""
+
+    def __init__(self, key, status, headers, ttl, etag, limit):
+        self.key = key
+        self.status = status
+        # (name, value) pairs as Zotero sent them
+        self.headers = headers
+        # None once it grew over limit, it is not cached then
+        self.body = bytearray()
+        self.limit = limit
+        self.ttl = ttl
+        self.etag = etag
+        self.stored = 0.0
+        self.size = 0
+
+    def capture(self, data):
+        if self.body is None:
+            return
+        if len(self.body) + len(data) > self.limit:
+            self.body = None
+        else:
+            self.body += data
+
+
+class ResponseCache:
+    """Responses of Zotero to idempotent GET requests, answered by the proxy while fresh.
+
+    Only the paths given a time to live are cached, read-only endpoints that plugins
+    poll such as /connector/ping, never the integration commands. Zotero's
+    Cache-Control shortens that time (max-age) or prevents caching (no-store,
+    no-cache, private). A request for a fresh response with its ETag in
+    If-None-Match is answered with 304, and a 304 from Zotero for a stale one makes
+    it fresh again. The least recently used responses are dropped to stay under
+    max_size bytes.
+    """
+
+    def __init__(self, ttls=None, max_size=RESPONSE_CACHE_SIZE):
+        self.ttls = dict(RESPONSE_CACHE_TTLS if ttls is None else ttls)
+        for path in UNCACHEABLE_PATHS:
+            self.ttls.pop(path, None)
+        self.max_size = max_size
+        # Key -> CachedResponse, least recently used first
+        self.entries = {}
+        self.size = 0
+        self.hits = 0
+
+    def key(self, zotero, request, headers):
+        """Key of a request whose response may be cached, None if it may not"""
+        parts = request.split(' ')
+        if parts[0] != 'GET' or len(parts) < 2 or parts[1].split('?')[0] not in self.ttls:
+            return None
+        if 'Authorization' in headers:
+            return None
+        return (zotero.address, parts[1])
+
+    def lookup(self, key, headers, now):
+        """Fresh response for a request with this key, None to forward it"""
+        entry = self.entries.get(key)
+        if entry is None or now >= entry.stored + entry.ttl:
+            # Stale ones are kept for a 304 to revalidate them
+            return None
+        if 'no-cache' in (headers.get('Cache-Control') or '') or 'no-cache' in (headers.get('Pragma') or ''):
+            return None
+        # Most recently used
+        del self.entries[key]
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def begin(self, key, status, headers, now):
+        """Start caching Zotero's response to a request with this key, None if it is not cached"""
+        control = (headers.get('Cache-Control') or '').lower()
+        if any(d in control for d in ('no-store', 'no-cache', 'private')) or 'Set-Cookie' in headers:
+            return None
+        # Responses that depend on request headers are not told apart
+        if 'Vary' in headers:
+            return None
+        ttl = self.ttls[key[1].split('?')[0]]
+        max_age = re.search(r'max-age=(\d+)', control)
+        if max_age:
+            ttl = min(ttl, int(max_age.group(1)))
+        code = status.split(' ')[1] if ' ' in status else ''
+        etag = headers.get('ETag')
+        if code == '304':
+            entry = self.entries.get(key)
+            if entry is not None and etag is not None and entry.etag == etag:
+                entry.stored = now
+                entry.ttl = ttl
+            return None
+        if code != '200' or ttl <= 0:
+            return None
+        return CachedResponse(key, status, headers.items(), ttl, etag, self.max_size)
+
+    def store(self, entry, now):
+        if entry.body is None:
+            return
+        old = self.entries.pop(entry.key, None)
+        if old is not None:
+            self.size -= old.size
+        entry.stored = now
+        entry.size = len(entry.body) + sum(len(k) + len(v) + 4 for k, v in entry.headers)
+        if entry.size > self.max_size:
+            return
+        while self.entries and self.size + entry.size > self.max_size:
+            self.size -= self.entries.pop(next(iter(self.entries))).size
+        self.entries[entry.key] = entry
+        self.size += entry.size
+
+    def response(self, entry, headers, keep_alive, now, compression=None, encoding=None):
+        """Answer a request from a cached response, return (response, status code)"""
+        response_headers = Headers()
+        for name, value in entry.headers:
+            if name.lower() not in ('content-length', 'transfer-encoding', 'connection', 'keep-alive', 'age'):
+                response_headers.add(name, value)
+        response_headers['Age'] = str(int(now - entry.stored))
+        if entry.etag is not None and etag_matches(headers.get('If-None-Match'), entry.etag):
+            return client_response_head('HTTP/1.1 304 Not Modified', response_headers, keep_alive), '304'
+        body = bytes(entry.body)
+        if compression is not None and compression.applies(entry.status, response_headers):
+            body = compression.encode(encoding, response_headers, body)
+        else:
+            response_headers['Content-Length'] = str(len(body))
+        return client_response_head(entry.status, response_headers, keep_alive) + body, '200'
+
+
+def preflight_response(request_headers, keep_alive):
+    """Answer a CORS preflight request that asked for the given headers"""
+    headers = Headers()
+    for k,v in PREFLIGHT_HEADERS.items():
+        headers[k] = v
+    if request_headers:
+        # A wildcard is not honored for credentialed requests, name them instead
+        headers['Access-Control-Allow-Headers'] = request_headers
+    headers['Access-Control-Max-Age'] = str(PREFLIGHT_MAX_AGE)
+    headers['Content-Length'] = '0'
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    return build_head('HTTP/1.1 200 OK', headers)
+
+
+def rate_limited_response(retry_after, keep_alive):
+    """Answer a request over its client's rate limit"""
+    body = b'Too many requests.'
+    headers = Headers()
+    headers['Content-Type'] = 'text/plain'
+    headers['Retry-After'] = str(retry_after)
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    return build_head('HTTP/1.1 429 Too Many Requests', headers) + body
+
+
+def upstream_request_head(request, headers, keep_alive, port=ZOTERO_PORT):
+    """Rewrite a client request head to be forwarded to Zotero"""
+    headers['Host'] = '127.0.0.1:{}'.format(port)
+    # Keep the upstream connection open for the pool, unless pooling is disabled
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    return build_head(request, headers)
+
+
+def client_response_head(status, headers, keep_alive):
+    """Rewrite a Zotero response head to be relayed to the client"""
+    # CORS
+    headers['Access-Control-Allow-Origin'] = '*'
+    drop_hop_headers(headers)
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    return build_head(status, headers)
+
+
+def client_key(uid, peer):
+    """Client a request is counted against: its user when known, its address otherwise
+
+    Without --user-map every local client is 127.0.0.1 (or the --unix path) and they share a bucket.
+    Keying on the connection would give a client opening one per request a full bucket each time.
+    """
+    if uid is not None:
+        return uid
+    return peer[0] if isinstance(peer, tuple) else peer
+
+
+class RateLimiter:
+    """Token bucket of each client, refilled with rate requests per second up to burst."""
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # Client -> (tokens left, when they were counted)
+        self.buckets = {}
+
+    def take(self, key, now):
+        """Take a token for a request, return 0 or the seconds to wait for one"""
+        tokens, counted = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - counted) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return math.ceil((1 - tokens) / self.rate)
+        self.buckets[key] = (tokens - 1, now)
+        return 0
+
+    def evict(self, now):
+        """Forget the clients whose bucket is full again"""
+        for key, (tokens, counted) in list(self.buckets.items()):
+            if tokens + (now - counted) * self.rate >= self.burst:
+                del self.buckets[key]
+
+
+class Compressor:
+    """Streams a body through gzip, deflate or brotli"""
+
+    def __init__(self, encoding, level=COMPRESS_LEVEL):
+        if encoding == 'br':
+            obj = brotli.Compressor(quality=level)
+            self.compress = obj.process
+            self.finish = obj.finish
+        else:
+            # 'deflate' is the zlib format, see RFC 9110
+            obj = zlib.compressobj(min(level, 9), zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+            self.compress = obj.compress
+            self.finish = obj.flush
+
+
+class Compression:
+    """Content encodings applied to responses for the client."""
+
+    def __init__(self, level=COMPRESS_LEVEL, min_size=COMPRESS_MIN_SIZE):
+        self.level = level
+        self.min_size = min_size
+        # In order of preference
+        self.encodings = ('gzip', 'deflate') if brotli is None else ('br', 'gzip', 'deflate')
+
+    def negotiate(self, accept_encoding):
+        """Preferred encoding in an Accept-Encoding header, None for identity"""
+        if not accept_encoding:
+            return None
+        weights = {}
+        for item in accept_encoding.split(','):
+            name, *params = item.split(';')
+            weight = 1.0
+            for param in params:
+                key, _, value = param.strip().partition('=')
+                if key.lower() == 'q':
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            weights[name.strip().lower()] = weight
+        best, best_weight = None, 0.0
+        for encoding in self.encodings:
+            weight = weights.get(encoding, weights.get('*', 0.0))
+            if weight > best_weight:
+                best, best_weight = encoding, weight
+        return best
+
+    def applies(self, status, headers):
+        """Whether a response with these status line and headers is compressed"""
+        code = status.split(' ')[1] if ' ' in status else ''
+        if not code.startswith('2') or code == '204' or 'Content-Encoding' in headers:
+            return False
+        content_type = (headers.get('Content-Type') or '').lower()
+        if not any(t in content_type for t in COMPRESSIBLE_TYPES):
+            return False
+        length = headers.get('Content-Length')
+        return not (length and length.isdigit() and int(length) < self.min_size)
+
+    def start(self, encoding, headers):
+        """Mark the response headers as encoded, return the Compressor for its body.
+
+        The length of the encoded body is not known in advance, the caller frames it.
+        """
+        headers.pop('Content-Length')
+        headers['Content-Encoding'] = encoding
+        vary = headers.get('Vary')
+        headers['Vary'] = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'
+        return Compressor(encoding, self.level)
+
+    def encode(self, encoding, headers, body):
+        """Compress a whole body if it is large enough, setting its Content-Length"""
+        if encoding is not None and len(body) >= self.min_size:
+            compressor = self.start(encoding, headers)
+            body = compressor.compress(body) + compressor.finish()
+        headers['Content-Length'] = str(len(body))
+        return body
+
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates when the log reaches max_bytes or is older than interval seconds,
+    archives are gzipped as <log>.1.gz, <log>.2.gz..."""
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT,
+                 interval=LOG_ROTATE_INTERVAL):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf8', delay=True)
+        self.interval = interval
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self.compress
+        if os.path.exists(filename):
+            self.rollover_at = os.path.getmtime(filename) + interval
+        else:
+            self.rollover_at = time.time() + interval
+
+    @staticmethod
+    def compress(source, dest):
+        import gzip
+        import shutil
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at and os.path.exists(self.baseFilename):
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + '.%03d' % record.msecs,
+            'level': record.levelname,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(logfile, fmt='text', level=logging.INFO, records=None):
+    """Log to a rotating file from a background thread, return the started QueueListener.
+
+    The level is that of the proxy's own logger, other modules log from INFO.
+    Worker processes share the file through a multiprocessing queue given as records.
+    """
+    handler = CompressedRotatingFileHandler(logfile)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s %(module)s: %(message)s',
+                                               datefmt='%Y-%m-%d %H:%M:%S'))
+    if records is None:
+        records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    # Callers only pay for putting the record in the queue, formatting and writing happen in the listener
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(logging.INFO)
+    log.setLevel(level)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
+
+
+def sample_log(rate):
+    """Whether to log the debug messages of a new request or connection"""
+    if rate <= 0:
+        return False
+    import random
+    return random.random() < rate
+
+
+class Batch:
+    """Commands collected for a request to BATCH_PATH.
+
+    The request body is forwarded to Zotero as a respond. As long as Zotero answers
+    with a command in VOID_COMMANDS, the proxy responds null on behalf of WPS and
+    reads the next one. WPS gets the array of commands, the last of which needs
+    its answer (or is Document.complete), and carries them all out in order.
+    """
+
+    def __init__(self, headers):
+        # Headers of the request forwarded to Zotero, reused to acknowledge commands
+        self.headers = headers
+        self.commands = []
+        # Status line and body of the last response from Zotero
+        self.status = ''
+        self.body = bytearray()
+
+    def add(self):
+        """Add the command in the response just read, return whether the proxy acknowledges it"""
+        body = bytes(self.body)
+        self.body.clear()
+        if ' ' not in self.status or not self.status.split(' ')[1].startswith('2'):
+            return False
+        try:
+            command = json.loads(body)
+        except ValueError:
+            return False
+        self.commands.append(command)
+        name = command.get('command') if isinstance(command, dict) else None
+        return isinstance(name, str) and name.split('.')[-1] in VOID_COMMANDS
+
+    @property
+    def last_command(self):
+        command = self.commands[-1] if self.commands else None
+        return command.get('command', '') if isinstance(command, dict) else ''
+
+    def ack_request(self):
+        """Request answering the last command with null"""
+        self.headers.pop('Transfer-Encoding')
+        self.headers['Content-Length'] = '4'
+        return build_head('POST {} HTTP/1.1'.format(RESPOND_PATH), self.headers) + b'null'
+
+    def response(self, keep_alive, compression=None, encoding=None):
+        """The commands with the status of Zotero's last response"""
+        body = json.dumps(self.commands).encode('utf8')
+        headers = Headers()
+        headers['Content-Type'] = 'application/json'
+        if compression is not None:
+            body = compression.encode(encoding, headers, body)
+        else:
+            headers['Content-Length'] = str(len(body))
+        headers['Access-Control-Allow-Origin'] = '*'
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        status = self.status.split(' ', 1)[1] if ' ' in self.status else '502 Bad Gateway'
+        return build_head('HTTP/1.1 ' + status, headers) + body
+
+
+def get_option(argv, name, default=None):
+    """Value of a `--name=value` or `--name value` command line option"""
+    for i, arg in enumerate(argv):
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+        if arg == name and i + 1 < len(argv):
+            return argv[i + 1]
+    return default
+
+
+def number_option(argv, name, default, kind=int, positive=False):
+    """Value of a command line option taking a number of the kind, raise ValueError with its usage if it is not one"""
+    value = get_option(argv, name)
+    if value is None:
+        return default
+    try:
+        number = kind(value)
+    except ValueError:
+        number = None
+    # Also rejects nan
+    if number is None or not (number > 0 if positive else number >= 0):
+        raise ValueError(f"Invalid {name} {value}, expected a {'positive' if positive else 'non-negative'} "
+                         f"{'integer' if kind is int else 'number'}")
+    return number
+
+
+# Parser states
+HEAD, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILER, UNTIL_CLOSE = range(7)
+
+
+class MessageParser:
+    """Incremental HTTP/1.x parser that hands out the body as it arrives."""
+
+    def __init__(self, is_request):
+        self.is_request = is_request
+        self.state = HEAD
+        self.head = bytearray()
+        self.line = bytearray()
+        # Bytes left in the body or in the current chunk
+        self.remaining = 0
+        self.chunked = False
+        # Whether the message is delimited by its framing rather than by closing
+        self.delimited = True
+        # Set while waiting for the response to a HEAD request
+        self.bodyless = False
+
+    @property
+    def in_progress(self):
+        return self.state != HEAD or bool(self.head)
+
+    def body_state(self, start_line, headers):
+        self.chunked = False
+        self.delimited = True
+        if self.bodyless:
+            return None
+
+        if not self.is_request:
+            status = start_line.split(' ')
+            if len(status) > 1 and (status[1].startswith('1') or status[1] in ('204', '304')):
+                return None
+
+        encoding = headers.get('Transfer-Encoding')
+        if encoding and encoding.split(',')[-1].strip().lower() == 'chunked':
+            self.chunked = True
+            return CHUNK_SIZE
+
+        content_length = headers.get('Content-Length')
+        if content_length:
+            self.remaining = int(content_length)
+            return BODY if self.remaining > 0 else None
+
+        if self.is_request:
+            # Requests without Content-Length carry no body
+            return None
+
+        # Read until close
+        self.delimited = False
+        return UNTIL_CLOSE
+
+    def read_line(self, data, pos):
+        """Accumulate a CRLF terminated line, return (line or None, new position)"""
+        n = len(data)
+        while pos < n:
+            c = data[pos]
+            pos += 1
+            if c == 10:
+                line = bytes(self.line).rstrip(b'\r')
+                self.line.clear()
+                return line, pos
+            self.line.append(c)
+            if len(self.line) > MAX_HEAD_SIZE:
+                raise ValueError('line too long')
+        return None, pos
+
+    def feed(self, data):
+        """Parse data, a bytes-like object, and return (events, bytes consumed).
+
+        Events are ('head', start_line, headers), ('body', data) and ('end',). Body
+        data may be a view on the caller's buffer. Parsing stops after the end of a
+        message so that the caller can decide what to do with what follows.
+        """
+        events = []
+        pos = 0
+        n = len(data)
+        while pos < n:
+            state = self.state
+            if state == HEAD:
+                start = max(0, len(self.head) - 3)
+                self.head += data[pos:]
+                end = self.head.find(b'\r\n\r\n', start)
+                if end < 0:
+                    if len(self.head) > MAX_HEAD_SIZE:
+                        raise ValueError('head too large')
+                    return events, n
+                pos = n - (len(self.head) - end - 4)
+                hd_raw = bytes(self.head[:end])
+                self.head.clear()
+                start_line, headers = parse_head(hd_raw)
+                events.append(('head', start_line, headers))
+                self.state = self.body_state(start_line, headers)
+                if self.state is None:
+                    return self.end(events), pos
+
+            elif state == BODY or state == CHUNK_DATA:
+                take = min(self.remaining, n - pos)
+                events.append(('body', data[pos:pos + take]))
+                pos += take
+                self.remaining -= take
+                if self.remaining == 0:
+                    if state == BODY:
+                        return self.end(events), pos
+                    self.state = CHUNK_END
+
+            elif state == UNTIL_CLOSE:
+                events.append(('body', data[pos:]))
+                pos = n
+
+            else:
+                line, pos = self.read_line(data, pos)
+                if line is None:
+                    break
+                if state == CHUNK_SIZE:
+                    self.remaining = int(line.split(b';')[0].strip(), 16)
+                    self.state = CHUNK_DATA if self.remaining > 0 else TRAILER
+                elif state == CHUNK_END:
+                    if line:
+                        raise ValueError('bad chunk terminator')
+                    self.state = CHUNK_SIZE
+                elif not line:
+                    # Trailer fields are dropped
+                    return self.end(events), pos
+
+        return events, pos
+
+    def end(self, events):
+        events.append(('end',))
+        self.state = HEAD
+        self.bodyless = False
+        return events
+
+    def eof(self):
+        """The peer has closed, return the events that finish the message, None if it was cut short."""
+        if self.state == UNTIL_CLOSE:
+            return self.end([])
+        if self.in_progress:
+            self.state = HEAD
+            self.head.clear()
+            return None
+        return []
+
+
+def create_listener(host, port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # NOTE: Setting this on Windows will cause multiple instances listening on the same port.
+    if os.name == 'posix':
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen()
+    server.setblocking(False)
+    return server
+
+
+def inherit_listener(fd):
+    """Listen on a socket inherited as file descriptor fd, its family is taken from the socket"""
+    server = socket.socket(fileno=fd)
+    server.setblocking(False)
+    return server
+
+
+def activated_listeners():
+    """Listening sockets passed by systemd socket activation, see sd_listen_fds(3)"""
+    try:
+        if int(os.environ.get('LISTEN_PID', 0)) != os.getpid():
+            return []
+        count = int(os.environ.get('LISTEN_FDS', 0))
+    except ValueError:
+        return []
+    # Meant for this process only, not for the ones it starts
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    return [inherit_listener(fd) for fd in range(LISTEN_FDS_START, LISTEN_FDS_START + count)]
+
+
+def create_unix_listener(path, mode=UNIX_SOCKET_MODE):
+    """Listen on a Unix socket at path, only accessible with the given permissions"""
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise FileExistsError(errno.EEXIST, 'not a socket', path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # Left behind by a proxy that did not exit cleanly
+            os.unlink(path)
+        else:
+            raise OSError(errno.EADDRINUSE, 'another proxy listens on', path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The socket file is created with the right permissions, not changed after the fact
+    umask = os.umask(0o777 & ~mode)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    server.setblocking(False)
+    return server
+
+
+def remove_unix_listener(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def stop_proxy(port=PROXY_PORT, path=None):
+    s = socket.socket(socket.AF_UNIX if path else socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.settimeout(1.0)
+        s.connect(path or ('127.0.0.1', port))
+        s.send(b'POST /stopproxy HTTP/1.1\r\n\r\n')
+    except Exception as e:
+        print(f"Failed to stop proxy: {e}")
+    finally:
+        s.close()
+
+
+class Timeouts:
+    """Seconds a connection may spend in each phase before it is closed."""
+
+    def __init__(self, connect=CONNECT_TIMEOUT, header=HEADER_TIMEOUT, read=READ_TIMEOUT,
+                 keep_alive=KEEP_ALIVE_TIMEOUT):
+        self.connect = connect
+        self.header = header
+        self.read = read
+        self.keep_alive = keep_alive
+
+
+# Connection roles
+CLIENT = 'client'
+UPSTREAM = 'upstream'
+
+
+class Connection:
+    """A non-blocking socket with its own read and write buffers."""
+
+    __slots__ = ('sock', 'peer', 'role', 'parser', 'wbuf', 'relay_chunked', 'events', 'connecting', 'closing',
+                 'closed', 'last_active', 'request', 'reused', 'pooled', 'reusable', 'busy', 'backlog', 'forwarding',
+                 'keep_alive', 'chunked_ok', 'labels', 'started', 'body_bytes', 'hop', 'sampled', 'batch',
+                 'encoding', 'compressor', 'zotero', 'uid', 'paused', 'rejected', 'head_started', 'timer',
+                 'exchange', 'cache_key', 'cached')
+
+    def __init__(self, sock, peer, role):
+        self.sock = sock
+        self.peer = peer
+        # CLIENT (accepted from WPS) or UPSTREAM (to Zotero)
+        self.role = role
+        self.parser = MessageParser(is_request=role == CLIENT)
+        self.wbuf = bytearray()
+        # Whether the body being read is re-encoded as chunks towards the peer
+        self.relay_chunked = False
+        self.events = 0
+        self.connecting = False
+        self.closing = False
+        self.closed = False
+        self.last_active = time.monotonic()
+        # Upstream only: forwarded request, kept to retry on a stale pooled connection
+        self.request = None
+        self.reused = False
+        self.pooled = False
+        self.reusable = False
+        # Set while a request is in flight on this connection
+        self.busy = False
+        # Client only: bytes of pipelined requests waiting for the one in flight to be answered
+        self.backlog = bytearray()
+        self.forwarding = False
+        self.keep_alive = False
+        self.chunked_ok = False
+        # Metrics: labels of the request in flight, when it (or the connect) started,
+        # and body bytes read for the current message
+        self.labels = ()
+        self.started = 0.0
+        self.body_bytes = 0
+        # Client only: TraceHop of the request in flight when tracing
+        self.hop = None
+        # Whether debug messages are logged for this connection's current request
+        self.sampled = False
+        # Client only: Batch being driven for the request in flight
+        self.batch = None
+        # Client only: content encoding negotiated for the response in flight
+        self.encoding = None
+        # Upstream only: Compressor the response body is streamed through
+        self.compressor = None
+        # Zotero instance the client is routed to, or the upstream connection belongs to
+        self.zotero = None
+        # Client only: UID of the client's owner when routing by user
+        self.uid = None
+        # Whether reading is paused until the peer's write buffer drains (or the backlog is answered)
+        self.paused = False
+        # Client only: accepted over the connection limit, its request is answered with 503
+        self.rejected = False
+        # When the first bytes of the message head being read arrived
+        self.head_started = 0.0
+        # Deadline of the connection's entry in the timer heap, None if it has none
+        self.timer = None
+        # Upstream only: Exchange being recorded
+        self.exchange = None
+        # Client only: ResponseCache key of the request in flight, None if its response is not cached
+        self.cache_key = None
+        # Upstream only: CachedResponse being filled
+        self.cached = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class UpstreamPool:
+    """Idle keep-alive connections to Zotero, most recently used first."""
+
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+
+    def __len__(self):
+        return len(self.idle)
+
+    def is_healthy(self, conn):
+        # An idle connection must have nothing to read: data is unexpected, b'' means closed.
+        try:
+            return not conn.sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+
+    def acquire(self):
+        """Take a healthy idle connection, return (conn, stale connections)"""
+        stale = []
+        while self.idle:
+            conn = self.idle.pop()
+            conn.pooled = False
+            if self.is_healthy(conn):
+                conn.reused = True
+                return conn, stale
+            stale.append(conn)
+        return None, stale
+
+    def release(self, conn):
+        """Put a connection back, return False if the pool is full"""
+        if len(self.idle) >= self.max_size:
+            return False
+        conn.pooled = True
+        conn.request = None
+        conn.last_active = time.monotonic()
+        self.idle.append(conn)
+        return True
+
+    def discard(self, conn):
+        conn.pooled = False
+        try:
+            self.idle.remove(conn)
+        except ValueError:
+            pass
+
+    def evict(self, now):
+        """Remove and return the connections idle for too long"""
+        expired = [c for c in self.idle if now - c.last_active > self.idle_timeout]
+        for conn in expired:
+            self.discard(conn)
+        return expired
+
+
+class Connections:
+    """Open connections of a ProxyServer, by role."""
+
+    def __init__(self):
+        self.clients = set()
+        self.upstreams = set()
+
+    def __len__(self):
+        return len(self.clients) + len(self.upstreams)
+
+    def __iter__(self):
+        # Over a copy, connections are closed while iterating
+        return iter([*self.clients, *self.upstreams])
+
+    def add(self, conn):
+        (self.clients if conn.role == CLIENT else self.upstreams).add(conn)
+
+    def discard(self, conn):
+        (self.clients if conn.role == CLIENT else self.upstreams).discard(conn)
+
+
+class ZoteroStatus:
+    """Remembers that Zotero could not be reached, so that a burst of requests gets
+    its 503 without paying a failed connect each.
+
+    After a failed connect it is tried again down_ttl later. After a failed probe
+    (see ZoteroProber) it is down until the next one, which requests for it bring
+    forward.
+    """
+
+    def __init__(self, down_ttl=ZOTERO_DOWN_TTL):
+        self.down_ttl = down_ttl
+        self.down_until = 0.0
+        # Set by ZoteroProber: when it last checked, how long /connector/ping took, the
+        # version Zotero reported, and when to check again
+        self.probed = None
+        self.latency = None
+        self.version = None
+        self.next_probe = 0.0
+        # Failed probes in a row, the interval between them doubles with each
+        self.failures = 0
+
+    @property
+    def down(self):
+        return time.monotonic() < self.down_until
+
+    def mark_down(self, until=None):
+        self.down_until = until or time.monotonic() + self.down_ttl
+
+    def mark_up(self):
+        self.down_until = 0.0
+
+    def expedite(self):
+        """Probe again soon, a request was refused because Zotero was down"""
+        if self.probed is not None:
+            self.next_probe = self.down_until = min(self.next_probe, self.probed + self.down_ttl)
+
+
+class Zotero(ZoteroStatus):
+    """A Zotero instance requests are forwarded to, with its idle connections.
+
+    It is reached on a Unix socket at path when one is given, on port otherwise.
+    """
+
+    def __init__(self, port, pool, path=None):
+        super().__init__()
+        self.port = port
+        self.pool = pool
+        self.path = path
+        self.address = path or ('127.0.0.1', port)
+
+
+def load_user_map(path):
+    """{uid: Zotero port} read from a file of `user port` lines, users given by name or UID"""
+    import pwd
+    users = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                user, port = line.split()
+                uid = int(user) if user.isdigit() else pwd.getpwnam(user).pw_uid
+                users[uid] = int(port)
+            except (KeyError, ValueError):
+                raise ValueError('{}:{}: expected "user port", got {!r}'.format(path, number, line))
+    return users
+
+
+def proc_net_address(address, family):
+    """An (ip, port) pair as written in /proc/net/tcp or /proc/net/tcp6"""
+    packed = socket.inet_pton(family, address[0])
+    # Each 32-bit word of the address is printed in host byte order
+    words = [int.from_bytes(packed[i:i + 4], sys.byteorder) for i in range(0, len(packed), 4)]
+    return ''.join('%08X' % word for word in words) + ':%04X' % address[1]
+
+
+def peer_uid(sock):
+    """UID owning the other end of a loopback connection, None if it cannot be found.
+
+    The kernel lists every TCP socket with its owner in /proc/net/tcp (Linux only),
+    the client's is the one whose addresses are ours swapped. Unix sockets carry
+    the credentials of their peer.
+    """
+    try:
+        family = sock.family
+        if family == AF_UNIX:
+            # struct ucred: pid, uid, gid
+            return struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12))[1]
+        local = proc_net_address(sock.getpeername(), family)
+        remote = proc_net_address(sock.getsockname(), family)
+        table = '/proc/net/tcp6' if family == socket.AF_INET6 else '/proc/net/tcp'
+        with open(table) as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[1] == local and fields[2] == remote:
+                    return int(fields[7])
+    except (OSError, ValueError, IndexError, StopIteration):
+        pass
+    return None
+
+
+class ZoteroRouter:
+    """Picks the Zotero instance a client's requests are forwarded to.
+
+    Without a user map every client goes to the instance on `port`. With one, a
+    single proxy serves all the users of a host: each client goes to the Zotero of
+    the user owning it, and clients of other users are refused.
+    """
+
+    def __init__(self, port=ZOTERO_PORT, user_map=None, pool_class=UpstreamPool, pool_size=POOL_MAX_SIZE,
+                 path=None):
+        self.port = port
+        # Unix socket of the Zotero used without a user map
+        self.path = path
+        self.user_map = user_map
+        self.pool_class = pool_class
+        self.pool_size = pool_size
+        # Port or socket path -> Zotero
+        self.instances = {}
+
+    def instance(self, port, path=None):
+        zotero = self.instances.get(path or port)
+        if zotero is None:
+            zotero = Zotero(port, self.pool_class(max_size=self.pool_size), path)
+            self.instances[path or port] = zotero
+        return zotero
+
+    def client_uid(self, sock):
+        """UID of a client, only looked up when routing by user"""
+        return None if self.user_map is None or sock is None else peer_uid(sock)
+
+    def route(self, uid):
+        """Zotero for a client of this UID, None if the user has none"""
+        if self.user_map is None:
+            return self.instance(self.port, self.path)
+        port = self.user_map.get(uid)
+        return None if port is None else self.instance(port)
+
+    def may_stop(self, uid):
+        """Whether a client may stop the proxy, only its owner can when it is shared"""
+        return self.user_map is None or uid == os.getuid()
+
+    def idle(self):
+        return sum(len(zotero.pool) for zotero in self.instances.values())
+
+    def evict(self, now):
+        """Remove and return the expired idle connections of every instance"""
+        expired = []
+        for zotero in self.instances.values():
+            expired += zotero.pool.evict(now)
+        return expired
+
+
+class ZoteroProber:
+    """Checks in a background thread that every Zotero of a router answers.
+
+    Each one is sent GET /connector/ping every `interval` seconds. One that cannot be
+    connected to is marked down until the next check, done after a delay doubling
+    from ZOTERO_DOWN_TTL up to PROBE_MAX_INTERVAL. A Zotero that accepts the
+    connection but is slow to answer, busy with a dialog, is not marked down.
+    """
+
+    def __init__(self, router, interval=PROBE_INTERVAL, timeout=CONNECT_TIMEOUT):
+        self.router = router
+        self.interval = interval
+        self.timeout = timeout
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.router.user_map is None:
+            # Check the only Zotero right away, without waiting for a first request
+            self.router.route(None)
+        self.stopped.clear()
+        threading.Thread(target=self.run, name='zotero-prober', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            # Instances are added by the server's thread
+            for zotero in list(self.router.instances.values()):
+                if now >= zotero.next_probe:
+                    self.probe(zotero)
+            # Often enough to notice requests bringing a check forward
+            if self.stopped.wait(ZOTERO_DOWN_TTL):
+                return
+
+    def probe(self, zotero):
+        started = time.monotonic()
+        sock = socket.socket(socket.AF_UNIX if zotero.path else socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            try:
+                sock.connect(zotero.address)
+            except OSError as e:
+                log.debug("Zotero probe failed: {}".format(e))
+                zotero.failures += 1
+                zotero.probed = started
+                zotero.next_probe = started + min(PROBE_MAX_INTERVAL, zotero.down_ttl * 2 ** (zotero.failures - 1))
+                zotero.mark_down(zotero.next_probe)
+                return
+            zotero.failures = 0
+            zotero.mark_up()
+            zotero.latency = None
+            head = bytearray()
+            try:
+                sock.sendall('GET {} HTTP/1.1\r\nHost: 127.0.0.1:{}\r\nConnection: close\r\n\r\n'.format(
+                    CONNECTOR_PING_PATH, zotero.port).encode('latin-1'))
+                while b'\r\n\r\n' not in head:
+                    data = sock.recv(BUFSIZE)
+                    if not data:
+                        break
+                    head += data
+            except OSError as e:
+                log.debug("Zotero probe got no answer: {}".format(e))
+            if b'\r\n\r\n' in head:
+                zotero.latency = time.monotonic() - started
+                _, headers = parse_head(bytes(head.split(b'\r\n\r\n', 1)[0]))
+                zotero.version = headers.get('X-Zotero-Version', zotero.version)
+            zotero.probed = started
+            zotero.next_probe = started + self.interval
+        finally:
+            sock.close()
+
+
+def health_response(zotero, uptime, keep_alive):
+    """Answer HEALTH_PATH from what is known of a client's Zotero, 503 unless it is reachable"""
+    now = time.monotonic()
+    ready = zotero is not None and not zotero.down
+    state = None
+    if zotero is not None:
+        state = {
+            'address': zotero.path or '127.0.0.1:{}'.format(zotero.port),
+            'reachable': not zotero.down,
+            'version': zotero.version,
+            'latency': None if zotero.latency is None else round(zotero.latency, 6),
+            'probed': None if zotero.probed is None else round(now - zotero.probed, 3),
+        }
+    body = json.dumps({'ready': ready, 'uptime': round(uptime, 3), 'zotero': state}).encode('utf8')
+    headers = Headers()
+    headers['Content-Type'] = 'application/json'
+    headers['Cache-Control'] = 'no-store'
+    headers['Access-Control-Allow-Origin'] = '*'
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    return build_head('HTTP/1.1 200 OK' if ready else 'HTTP/1.1 503 Service Unavailable', headers) + body
+
+
+def metric_path(request):
+    """Path label of a request line, connector paths only to keep the label set small"""
+    parts = request.split(' ')
+    path = parts[1].split('?')[0] if len(parts) > 1 else ''
+    return path if path.startswith('/connector/') else 'other'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket, and one for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """In-process counters, gauges and histograms, served in the Prometheus text format.
+
+    Samples are keyed by metric name and a tuple of (label, value) pairs. Values
+    kept elsewhere are collected by calling a function when rendering.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collected = {}
+        # Labels of every sample, the worker's pid in --workers processes
+        self.labels = ()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(buckets)
+        histogram.observe(value)
+
+    def error(self, category):
+        self.inc('wps_zotero_errors_total', (('category', category),))
+
+    def collect(self, name, func):
+        self.collected[name] = func
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text) in METRIC_TYPES.items():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if name in self.collected:
+                lines.append('{}{} {}'.format(name, format_labels(self.labels), self.collected[name]()))
+            for (sample, labels), value in sorted(self.counters.items()):
+                if sample == name:
+                    lines.append('{}{} {}'.format(name, format_labels(self.labels + labels), value))
+            for (sample, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if sample != name:
+                    continue
+                labels = self.labels + labels
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+        return ('\n'.join(lines) + '\n').encode('utf8')
+
+    def response(self, keep_alive):
+        body = self.render()
+        headers = Headers()
+        headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        return build_head('HTTP/1.1 200 OK', headers) + body
+
+
+def otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class TraceHop:
+    """One request/response exchange of an integration transaction."""
+
+    def __init__(self, path, started, zotero=None):
+        self.path = path
+        # Address of the Zotero the request is forwarded to
+        self.zotero = zotero
+        # Monotonic times: request head received, request forwarded, response relayed
+        self.started = started
+        self.forwarded = started
+        self.ended = started
+        self.request_body = bytearray()
+        self.response_body = bytearray()
+        self.status = ''
+        # Command Zotero answered with
+        self.command = ''
+
+    def capture(self, data, is_request):
+        body = self.request_body if is_request else self.response_body
+        if len(body) < TRACE_CAPTURE_SIZE:
+            body += data[:TRACE_CAPTURE_SIZE - len(body)]
+
+
+class Transaction:
+    """An execCommand and the respond exchanges that follow, until Document.complete."""
+
+    def __init__(self, doc_id, command):
+        self.doc_id = doc_id
+        self.command = command
+        self.hops = []
+
+    def breakdown(self):
+        """Seconds spent in Zotero, in the proxy and in WPS"""
+        zotero = proxy = wps = 0.0
+        previous = None
+        for hop in self.hops:
+            zotero += hop.ended - hop.forwarded
+            proxy += hop.forwarded - hop.started
+            if previous is not None:
+                wps += hop.started - previous.ended
+            previous = hop
+        return zotero, proxy, wps
+
+    def spans(self):
+        """(name, category, start, end, attributes) of the segments of the transaction"""
+        spans = []
+        previous = None
+        for hop in self.hops:
+            if previous is not None:
+                # WPS carrying out the previous command, see js/wpsif.js
+                spans.append((previous.command or 'respond', 'wps', previous.ended, hop.started, {}))
+            spans.append(('proxy', 'proxy', hop.started, hop.forwarded, {'path': hop.path}))
+            spans.append((hop.command or hop.path, 'zotero', hop.forwarded, hop.ended,
+                          {'path': hop.path, 'status': hop.status}))
+            previous = hop
+        return spans
+
+
+class BackgroundWriter:
+    """Writes files from a background thread, so that the event loop never waits for the disk.
+
+    Like the QueueListener of setup_logging, callers only put the write in a queue.
+    The thread is started by the first write of each process, forked workers get their own.
+    """
+
+    def __init__(self):
+        self.jobs = None
+        self.thread = None
+        self.pid = None
+
+    def submit(self, write, *args):
+        """Call write(*args) in the background thread"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.jobs = queue.SimpleQueue()
+            self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+            self.thread.start()
+        self.jobs.put((write, args))
+
+    def run(self):
+        while True:
+            write, args = self.jobs.get()
+            if write is None:
+                return
+            try:
+                write(*args)
+            except Exception as e:
+                logging.error('Background write failed: {}'.format(e))
+
+    def stop(self):
+        """Wait until the queued writes are done"""
+        if self.thread is not None and self.pid == os.getpid():
+            self.jobs.put((None, ()))
+            self.thread.join()
+        self.thread = None
+        self.pid = None
+
+
+class Tracer:
+    """Links the hops of integration transactions and writes one trace file per transaction.
+
+    Each Zotero runs one integration session at a time, so a respond request belongs to
+    the transaction started by the last execCommand sent to the same Zotero: with
+    --user-map, every user's Zotero has its own. Traces are written as Chrome trace
+    JSON (chrome://tracing, Perfetto) or as OTLP JSON.
+    """
+
+    def __init__(self, directory, fmt='chrome'):
+        self.directory = directory
+        self.format = fmt
+        # Address of a Zotero -> Transaction in progress on it
+        self.current = {}
+        self.written = 0
+        # Converts monotonic times to wall clock ones
+        self.epoch = time.time() - time.monotonic()
+        self.writer = BackgroundWriter()
+        os.makedirs(directory, exist_ok=True)
 
+    def begin(self, request, started, zotero):
+        """Start a hop for a request line forwarded to zotero, None for requests that are not traced"""
+        path = metric_path(request)
+        if not path.startswith('/connector/document/'):
+            return None
+        return TraceHop(path, started, None if zotero is None else zotero.address)
 
-def parse_head(hd_raw):
+    def end(self, hop, status):
+        hop.ended = time.monotonic()
+        hop.status = status
+        match = None if hop.command else TRACE_COMMAND.search(hop.response_body)
+        if match:
+            hop.command = match.group(1).decode('utf8', 'replace')
+
+        if hop.path.endswith('/execCommand'):
+            previous = self.current.pop(hop.zotero, None)
+            if previous is not None:
+                self.finish(previous, complete=False)
+            command = TRACE_COMMAND.search(hop.request_body)
+            doc_id = TRACE_DOC_ID.search(hop.request_body)
+            self.current[hop.zotero] = Transaction(doc_id.group(1).decode('utf8', 'replace') if doc_id else '',
+                                                   command.group(1).decode('utf8', 'replace') if command else '')
+        transaction = self.current.get(hop.zotero)
+        if transaction is None:
+            return
+        transaction.hops.append(hop)
+        if hop.command == 'Document.complete' or not status.startswith('2'):
+            self.finish(transaction, complete=hop.command == 'Document.complete')
+            del self.current[hop.zotero]
+
+    def finish(self, transaction, complete):
+        zotero, proxy, wps = transaction.breakdown()
+        logging.info('transaction {} on {}: {} commands, zotero {:.3f} s, proxy {:.3f} s, wps {:.3f} s{}'.format(
+            transaction.command, transaction.doc_id, len(transaction.hops), zotero, proxy, wps,
+            '' if complete else ' (incomplete)'))
+        self.written += 1
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.epoch + transaction.hops[0].started))
+        doc_id = re.sub(r'[^A-Za-z0-9_.-]', '_', transaction.doc_id)[:64] or 'nodoc'
+        name = '{}-{}-{}-{}.json'.format(stamp, self.written, doc_id, transaction.command or 'command')
+        if self.format == 'otlp':
+            data = self.otlp(transaction, complete)
+        else:
+            data = self.chrome(transaction, complete)
+        self.writer.submit(self.write, os.path.join(self.directory, name), data)
+
+    def write(self, path, data):
+        try:
+            with open(path, 'w') as f:
+                json.dump(data, f)
+        except OSError as e:
+            logging.error('Failed to write trace: {}'.format(e))
+
+    def close(self):
+        """Wait until the finished traces are written"""
+        self.writer.stop()
+
+    def chrome(self, transaction, complete):
+        us = lambda t: int((self.epoch + t) * 1e6)
+        zotero, proxy, wps = transaction.breakdown()
+        start, end = transaction.hops[0].started, transaction.hops[-1].ended
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1, 'args': {'name': transaction.doc_id}},
+            {'name': transaction.command, 'cat': 'transaction', 'ph': 'X', 'pid': 1, 'tid': 1,
+             'ts': us(start), 'dur': us(end) - us(start),
+             'args': {'docId': transaction.doc_id, 'commands': len(transaction.hops), 'complete': complete,
+                      'zotero_ms': zotero * 1000, 'proxy_ms': proxy * 1000, 'wps_ms': wps * 1000}},
+        ]
+        for name, category, t0, t1, attributes in transaction.spans():
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': 1,
+                           'ts': us(t0), 'dur': us(t1) - us(t0), 'args': attributes})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def otlp(self, transaction, complete):
+        ns = lambda t: str(int((self.epoch + t) * 1e9))
+        attribute = otlp_attribute
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+        start, end = transaction.hops[0].started, transaction.hops[-1].ended
+        spans = [{
+            'traceId': trace_id, 'spanId': root_id, 'name': transaction.command, 'kind': 2,
+            'startTimeUnixNano': ns(start), 'endTimeUnixNano': ns(end),
+            'attributes': [attribute('zotero.doc_id', transaction.doc_id),
+                           attribute('zotero.commands', len(transaction.hops)),
+                           attribute('zotero.complete', complete)],
+        }]
+        for name, category, t0, t1, attributes in transaction.spans():
+            spans.append({
+                'traceId': trace_id, 'spanId': os.urandom(8).hex(), 'parentSpanId': root_id,
+                'name': name, 'kind': 3 if category == 'zotero' else 1,
+                'startTimeUnixNano': ns(t0), 'endTimeUnixNano': ns(t1),
+                'attributes': [attribute('wps_zotero.segment', category)] +
+                              [attribute('http.' + k, v) for k, v in attributes.items()],
+            })
+        return {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name', 'wps-zotero-proxy')]},
+            'scopeSpans': [{'scope': {'name': 'wps-zotero-proxy'}, 'spans': spans}],
+        }]}
+
+
+def record_body(data):
+    """A body as a JSON value: text when it is UTF-8, {"base64": ...} otherwise"""
     try:
-        head = hd_raw.decode('utf8').split("\r\n")
+        return data.decode('utf8')
     except UnicodeDecodeError:
-        # Fallback to latin-1 if utf8 fails
-        head = hd_raw.decode('latin-1').split("\r\n")
+        return {'base64': base64.b64encode(data).decode('ascii')}
 
-    request = head[0]
-    headers = {}
-    for line in head[1:]:
-        if not line:
-            continue
-        # Split by first colon only
-        parts = line.split(':', 1)
-        if len(parts) == 2:
-            key = parts[0].strip()
-            # We don't change case of key here, but handle lookup case-insensitively
-            headers[key] = parts[1].strip()
-
-    return request, headers
-
-
-def get_header(headers, key):
-    """Case-insensitive header lookup"""
-    key_lower = key.lower()
-    for k, v in headers.items():
-        if k.lower() == key_lower:
-            return v
-    return None
 
+class Exchange:
+    """A request forwarded to Zotero and its response, being recorded."""
 
-def recv_all(sock):
-    data = b''
-    closed = False
+    def __init__(self, request, headers, started):
+        self.request = request
+        self.headers = headers.items()
+        self.body = bytearray()
+        self.started = started
+        # When the request was sent whole, and its response head arrived
+        self.forwarded = started
+        self.answered = started
+        self.status = ''
+        self.response_headers = []
+        self.response_body = bytearray()
+        self.truncated = False
 
-    # Read in Http head
-    while True:
-        try:
-            part = sock.recv(BUFSIZE)
-        except (ConnectionResetError, socket.timeout):
-            closed = True
-            break
-        except BlockingIOError:
-            break
-
-        if not part:
-            closed = True
-            break
-        data += part
-        if b'\r\n\r\n' in data:
-            break
-
-    if not data:
-        return data
+    def capture(self, data, is_request):
+        body = self.body if is_request else self.response_body
+        room = RECORD_BODY_LIMIT - len(body)
+        if len(data) > room:
+            self.truncated = True
+            data = data[:max(0, room)]
+        body += data
 
-    hd_raw = data.partition(b'\r\n\r\n')[0]
-    req, headers = parse_head(hd_raw)
+    def respond(self, status, headers):
+        self.answered = time.monotonic()
+        self.status = status
+        # As Zotero sent them, before they are rewritten for the client
+        self.response_headers = headers.items()
 
-    # Read full body
-    content_length = get_header(headers, 'Content-Length')
-    if content_length:
-        length = len(hd_raw) + 4 + int(content_length)
-        while len(data) < length:
-            try:
-                part = sock.recv(BUFSIZE)
-                if not part:
-                    closed = True
-                    break
-                data += part
-            except (ConnectionResetError, socket.timeout):
-                closed = True
-                break
-    elif not closed:
-        # No Content-Length.
-        is_request = not req.startswith('HTTP/')
-        expect_body = True
-
-        if is_request:
-            method = req.split(' ')[0].upper()
-            if method in ['GET', 'HEAD', 'OPTIONS', 'TRACE', 'DELETE']:
-                expect_body = False
-
-        if expect_body:
-            # Read until close
-            while True:
-                try:
-                    part = sock.recv(BUFSIZE)
-                    if not part:
-                        closed = True
-                        break
-                    data += part
-                except socket.timeout:
-                    closed = True
-                    break
-                except ConnectionResetError:
-                    closed = True
-                    break
 
-    return data
+class Recorder:
+    """Writes the exchanges with Zotero to a session file, for bench/replay.py.
 
+    A session is gzip compressed JSON Lines, one exchange per line, with its
+    times in seconds from the start of the proxy. Each process writes its own.
+    """
 
-def stop_proxy():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.settimeout(1.0)
-        s.connect(('127.0.0.1', PROXY_PORT))
-        s.send(b'POST /stopproxy HTTP/1.1\r\n\r\n')
-    except Exception as e:
-        print(f"Failed to stop proxy: {e}")
-    finally:
-        s.close()
+    def __init__(self, directory):
+        self.directory = directory
+        self.started = time.monotonic()
+        self.file = None
+        self.pid = None
+        self.written = 0
+        self.flushed = 0.0
+        self.writer = BackgroundWriter()
+        os.makedirs(directory, exist_ok=True)
+
+    def begin(self, request, headers, started, body=None):
+        """Start recording a request line sent with headers, or a whole request with its body"""
+        exchange = Exchange(request, headers, started)
+        if body is not None:
+            exchange.capture(body, True)
+        return exchange
+
+    def open(self):
+        """Start the session file of this process, called by the writer thread"""
+        import gzip
+        self.pid = os.getpid()
+        name = 'session-{}-{}.jsonl.gz'.format(time.strftime('%Y%m%d-%H%M%S'), self.pid)
+        self.file = gzip.open(os.path.join(self.directory, name), 'wt', compresslevel=COMPRESS_LEVEL,
+                              encoding='utf8')
 
+    def finish(self, exchange):
+        record = {
+            't': round(exchange.started - self.started, 6),
+            'request': exchange.request,
+            'headers': exchange.headers,
+            'body': record_body(bytes(exchange.body)),
+            # Time Zotero took to answer, and until the end of its response
+            'wait': round(exchange.answered - exchange.forwarded, 6),
+            'duration': round(time.monotonic() - exchange.started, 6),
+            'status': exchange.status,
+            'response_headers': exchange.response_headers,
+            'response_body': record_body(bytes(exchange.response_body)),
+        }
+        if exchange.truncated:
+            record['truncated'] = True
+        self.writer.submit(self.write, record)
 
-class ProxyServer:
-    input_list = []
-    channels = {}
-    clients = []
+    def write(self, record):
+        try:
+            if self.pid != os.getpid():
+                # A forked worker
+                self.open()
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.written += 1
+            now = time.monotonic()
+            if now - self.flushed > RECORD_FLUSH_INTERVAL:
+                # Readable up to here if the proxy is killed
+                self.file.flush()
+                self.flushed = now
+        except OSError as e:
+            logging.error('Failed to record exchange: {}'.format(e))
+
+    def close(self):
+        # The session file is only used by the writer thread, which is done once stopped
+        self.writer.stop()
+        if self.file is not None and self.pid == os.getpid():
+            self.file.close()
+        self.file = None
+
+
+class BaseProxyServer:
+    """Configuration and local answers shared by ProxyServer and AsyncProxyServer"""
 
-    def __init__(self, host, port, persistent=False):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Pool of the upstream connections to each Zotero instance
+    pool_class = UpstreamPool
+
+    def __init__(self, host, port, persistent=False, pool_size=POOL_MAX_SIZE, tracer=None, log_sample=0.0,
+                 batching=False, compression=None, zotero_port=ZOTERO_PORT, user_map=None, unix_path=None,
+                 unix_mode=UNIX_SOCKET_MODE, zotero_path=None, max_connections=MAX_CONNECTIONS, limiter=None,
+                 max_buffer=MAX_BUFFER, timeouts=None, recorder=None, listeners=None, idle_exit=IDLE_EXIT,
+                 probe_interval=PROBE_INTERVAL, cache=None):
+        # Sockets inherited from a launcher are listened on instead of host and port
+        self.listeners = list(listeners) if listeners else [create_listener(host, port)]
+        # Unix socket listened on besides the TCP port
+        self.unix_path = unix_path
+        if unix_path:
+            self.listeners.append(create_unix_listener(unix_path, unix_mode))
+        self.port = port
         self.persistent = persistent
-        # NOTE: Setting this on Windows will cause multiple instances listening on the same port.
-        if os.name == 'posix':
-            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((host, port))
-        self.server.listen()
+        # Seconds without clients after which run() returns, 0 to keep running
+        self.idle_exit = idle_exit
+        # When the last client disconnected
+        self.idle_since = time.monotonic()
+        self.router = ZoteroRouter(zotero_port, user_map, self.pool_class, pool_size, zotero_path)
+        self.timeouts = timeouts or Timeouts()
+        # Checks Zotero in the background while running, None to disable
+        self.prober = ZoteroProber(self.router, probe_interval, self.timeouts.connect) if probe_interval > 0 else None
+        self.start_time = time.monotonic()
+        self.max_connections = max_connections
+        # RateLimiter of forwarded requests, None to disable
+        self.limiter = limiter
+        self.max_buffer = max_buffer
+        # Whether upstream connections are kept for reuse
+        self.pooling = pool_size > 0
+        self.tracer = tracer
+        # Recorder of the exchanges with Zotero, None to disable
+        self.recorder = recorder
+        # ResponseCache of idempotent GET requests, None to disable
+        self.cache = cache
+        self.log_sample = log_sample
+        # Whether BATCH_PATH is answered by the proxy
+        self.batching = batching
+        # Compression of responses to clients that accept it, None to disable
+        self.compression = compression
+        self.preflights = PreflightCache()
+        self.metrics = Metrics()
+        self.metrics.collect('wps_zotero_active_channels', self.active_channels)
+        self.metrics.collect('wps_zotero_client_connections', self.client_connections)
+        self.metrics.collect('wps_zotero_idle_upstream_connections', self.router.idle)
+        self.metrics.collect('wps_zotero_preflight_cache_hits_total', lambda: self.preflights.hits)
+        if cache is not None:
+            self.metrics.collect('wps_zotero_response_cache_hits_total', lambda: cache.hits)
+            self.metrics.collect('wps_zotero_response_cache_bytes', lambda: cache.size)
+        self.running = False
+        # Whether the stop command was received
+        self.stop_requested = False
+        # Set by stop(), which may be called from a signal handler before running
+        self.stopping = False
+
+    def may_stop(self, uid):
+        """Log a stop command, return whether it is to be obeyed"""
+        logging.info('received stopping command!')
+        if self.persistent:
+            logging.info('Persistent mode enabled: ignoring stop command.')
+            return False
+        if not self.router.may_stop(uid):
+            logging.info('Shared by several users: ignoring stop command from another user.')
+            return False
+        return True
+
+    def answer_locally(self, request, headers, keep_alive, uid, peer, rejected, started, sampled):
+        """Answer a request the proxy handles itself, return (response, status, cache_key)
+
+        response is None when the request is to be forwarded to Zotero, cache_key is then set when its response
+        is to be cached. status is None for answers left out of wps_zotero_requests_total.
+        """
+        if rejected:
+            logging.warning("Too many connections, refusing {}".format(peer))
+            self.metrics.error('too_many_connections')
+            return TOO_MANY_CONNECTIONS, '503', None
+
+        if request.startswith('GET ' + METRICS_PATH):
+            return self.metrics.response(keep_alive), None, None
+
+        if request.startswith('GET ' + HEALTH_PATH):
+            return health_response(self.router.route(uid), started - self.start_time, keep_alive), None, None
+
+        # Preflight responses
+        if is_preflight(request, headers):
+            self.metrics.inc('wps_zotero_preflight_requests_total')
+            if sampled:
+                log.debug('responded to a preflight request')
+            return self.preflights.response(headers, keep_alive), None, None
+
+        cache_key = None
+        if self.cache is not None:
+            zotero = self.router.route(uid)
+            cache_key = self.cache.key(zotero, request, headers) if zotero is not None else None
+            entry = self.cache.lookup(cache_key, headers, started) if cache_key is not None else None
+            if entry is not None:
+                encoding = None
+                if self.compression is not None:
+                    encoding = self.compression.negotiate(headers.get('Accept-Encoding'))
+                data, code = self.cache.response(entry, headers, keep_alive, started, self.compression, encoding)
+                return data, code, None
+
+        if self.limiter is not None:
+            wait = self.limiter.take(client_key(uid, peer), started)
+            if wait:
+                # The body is dropped, the connection stays open if it can
+                self.metrics.error('rate_limited')
+                return rate_limited_response(wait, keep_alive), '429', None
+
+        return None, None, cache_key
+
+    def announce_batching(self, headers, path):
+        """Tell js/zclient.js in the response to execCommand that it may respond through BATCH_PATH"""
+        if self.batching and path == EXEC_PATH:
+            headers[BATCH_HEADER] = '1'
+            headers['Access-Control-Expose-Headers'] = BATCH_HEADER
+
+
+class ProxyServer(BaseProxyServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.registry = Connections()
+        # Heap of (deadline, sequence, connection), see schedule()
+        self.timers = []
+        self.sequence = itertools.count()
+        # When idle rate limiter buckets were last dropped
+        self.swept = 0.0
+        # Client <-> upstream connection of the requests being forwarded, both ways
+        self.channels = {}
+        # Created by run(), so that forked workers do not share it
+        self.selector = None
+        # Every read lands in this buffer, its content is copied out before the next one
+        self.buffer = bytearray(BUFSIZE)
+        self.view = memoryview(self.buffer)
+        # Connections with data queued by send(), flushed once per loop iteration
+        self.unflushed = set()
+
+    def active_channels(self):
+        return len(self.channels) // 2
+
+    def client_connections(self):
+        return len(self.registry.clients)
+
+    def stop(self):
+        self.stopping = True
         self.running = False
 
     def run(self):
-        self.input_list.append(self.server)
-        self.running = True
+        self.selector = selectors.DefaultSelector()
+        for listener in self.listeners:
+            self.selector.register(listener, selectors.EVENT_READ, None)
+        self.running = not self.stopping
+        if self.prober is not None:
+            self.prober.start()
         mode = "persistent" if self.persistent else "normal"
-        print(f"Proxy server running on {PROXY_PORT} (mode: {mode})...")
+        print(f"Proxy server running on {self.port} (mode: {mode})...")
         while self.running:
             try:
-                # Use a timeout in select to allow catching KeyboardInterrupt immediately
-                rlist, _, _ = select.select(self.input_list, [], [], 1.0)
+                # Wake up for the next deadline, and at least every second to catch KeyboardInterrupt
+                timeout = 1.0
+                if self.timers:
+                    timeout = min(timeout, max(0.0, self.timers[0][0] - time.monotonic()))
+                events = self.selector.select(timeout)
             except (KeyboardInterrupt, InterruptedError):
                 print("Stopping proxy server...")
                 self.running = False
@@ -168,199 +2001,1184 @@ class ProxyServer:
                 logging.error(f"Select error: {e}")
                 break
 
-            for s in rlist:
-                if s == self.server:
-                    self.on_accept()
-                    break
-
-                try:
-                    data = recv_all(s)
-                except Exception as e:
-                    logging.error("Error receiving data: {}".format(e))
-                    self.on_close(s)
+            for key, mask in events:
+                conn = key.data
+                if conn is None:
+                    self.on_accept(key.fileobj)
                     continue
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self.on_writable(conn)
+                if mask & selectors.EVENT_READ and not conn.closed:
+                    self.on_readable(conn)
 
-                if len(data) == 0:
-                    self.on_close(s)
-                else:
-                    self.on_recv(s, data)
+            self.check_timeouts()
+            while self.unflushed:
+                self.flush(self.unflushed.pop())
 
+        if self.prober is not None:
+            self.prober.stop()
         # Close all sockets
-        for s in self.input_list:
-            try:
-                s.close()
-            except Exception as e:
-                logging.error(f"Failed to close socket: {e}")
-        self.input_list.clear()
+        for conn in self.registry:
+            self.close(conn)
         self.channels.clear()
-        self.clients.clear()
         try:
-            self.server.close()
+            for listener in self.listeners:
+                self.selector.unregister(listener)
+                listener.close()
         except Exception as e:
             logging.error(f"Failed to close server: {e}")
+        self.selector.close()
 
-    def on_accept(self):
-        try:
-            clientsock, clientaddr = self.server.accept()
-        except Exception as e:
-            logging.error(f"Accept error: {e}")
-            return
+    def on_accept(self, listener):
+        while True:
+            try:
+                clientsock, clientaddr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                logging.error(f"Accept error: {e}")
+                return
 
-        # Set timeout to prevent hanging on recv
-        clientsock.settimeout(SOCKET_TIMEOUT)
+            clientsock.setblocking(False)
+            if clientsock.family == AF_UNIX:
+                clientaddr = clientaddr or self.unix_path
+            else:
+                clientsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = Connection(clientsock, clientaddr, CLIENT)
+            client.uid = self.router.client_uid(clientsock)
+            client.zotero = self.router.route(client.uid)
+            client.rejected = 0 < self.max_connections <= len(self.registry.clients)
+            self.registry.add(client)
+            self.watch(client, selectors.EVENT_READ)
+            self.schedule(client)
+            client.sampled = sample_log(self.log_sample)
+            if client.sampled:
+                log.debug("{} has connected".format(clientaddr))
 
-        self.clients.append(clientaddr)
-        self.input_list.append(clientsock)
-        logging.info("{} has connected".format(clientaddr))
-        forward = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            forward.settimeout(SOCKET_TIMEOUT)
-            forward.connect(('127.0.0.1', ZOTERO_PORT))
-        except socket.error as e:
-            logging.warning("Cannot connect to Zotero, is the app started?")
-            logging.debug("Failed to connect to Zotero: {}".format(e))
+    def open_upstream(self, client):
+        if client.zotero is None:
+            self.on_unmapped(client)
+            return None
+        upstream, stale = client.zotero.pool.acquire()
+        for conn in stale:
+            self.close(conn)
+        if upstream is None:
+            upstream = self.dial(client)
+            if upstream is None:
+                return None
+        self.channels[client] = upstream
+        self.channels[upstream] = client
+        return upstream
+
+    def dial(self, client):
+        zotero = client.zotero
+        if zotero.down:
+            zotero.expedite()
+            self.metrics.error('zotero_down')
+            self.on_connect_failed(client, 'unreachable a moment ago')
+            return None
+
+        if zotero.path:
+            forward = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            forward = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            forward.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        forward.setblocking(False)
+        err = forward.connect_ex(zotero.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
             forward.close()
-            # Respond with 503
-            try:
-                response = b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n\r\nZotero is not running.'
-                clientsock.send(response)
-                clientsock.close()
-            except Exception as e:
-                logging.error(f"Failed to send response: {e}")
+            zotero.mark_down()
+            self.metrics.error('connect_failed')
+            self.on_connect_failed(client, os.strerror(err))
+            return None
+
+        upstream = Connection(forward, zotero.address, UPSTREAM)
+        self.registry.add(upstream)
+        upstream.zotero = zotero
+        upstream.connecting = True
+        upstream.started = time.monotonic()
+        self.watch(upstream, selectors.EVENT_WRITE)
+        self.schedule(upstream)
+        return upstream
+
+    def on_connect_failed(self, client, reason):
+        logging.warning("Cannot connect to Zotero, is the app started?")
+        log.debug("Failed to connect to Zotero: {}".format(reason))
+        # Respond with 503
+        client.keep_alive = False
+        self.count_response(client, '503')
+        self.send(client, ZOTERO_NOT_RUNNING)
+        self.refuse(client)
 
-            if clientsock in self.input_list:
-                self.input_list.remove(clientsock)
-            if clientaddr in self.clients:
-                self.clients.remove(clientaddr)
+    def on_unmapped(self, client):
+        logging.warning("No Zotero port for the user of {} (uid {})".format(client.peer, client.uid))
+        self.metrics.error('unmapped_user')
+        client.keep_alive = False
+        self.count_response(client, '403')
+        self.send(client, USER_NOT_MAPPED)
+        self.refuse(client)
 
+    def refuse(self, client):
+        """Close a client once the error response sent for its request is flushed"""
+        if client.forwarding and not client.busy:
+            # Closing with part of the request unread would reset the connection, drop the
+            # rest of the request and close at its end
+            client.forwarding = False
+        else:
+            self.close_after_flush(client)
+
+    def watch(self, conn, events):
+        if events == conn.events:
             return
+        if events == 0:
+            self.selector.unregister(conn.sock)
+        elif conn.events == 0:
+            self.selector.register(conn.sock, events, conn)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
 
-        self.input_list.append(forward)
-        self.channels[clientsock] = forward
-        self.channels[forward] = clientsock
+    def on_readable(self, conn):
+        if conn.pooled:
+            # Zotero closed an idle connection (or sent something unexpected)
+            conn.zotero.pool.discard(conn)
+            self.close(conn)
+            return
 
-    def on_close(self, s):
         try:
-            pname = s.getpeername()
+            n = conn.sock.recv_into(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
         except Exception as e:
-            logging.error(f"Failed to get peer name: {e}")
-            pname = "unknown"
+            logging.error("Error receiving data: {}".format(e))
+            self.metrics.error('recv')
+            self.on_close(conn)
+            return
 
-        if pname in self.clients:
-            try:
-                self.clients.pop(self.clients.index(pname))
-            except ValueError:
-                pass
+        if n == 0:
+            events = conn.parser.eof()
+            if events is None:
+                logging.warning("{} closed in the middle of a message".format(conn.peer))
+                self.metrics.error('client_closed' if conn.role == CLIENT else 'upstream_closed')
+            else:
+                self.dispatch(conn, events)
+            self.on_close(conn)
+            return
+
+        conn.last_active = time.monotonic()
+        if not conn.parser.in_progress:
+            conn.head_started = conn.last_active
+        self.process(conn, self.view[:n])
+        self.schedule(conn)
 
-        if s in self.channels:
-            out = self.channels[s]
+    def process(self, conn, data):
+        while data and not (conn.closed or conn.closing):
+            if conn.busy and conn.role == CLIENT:
+                # Keep pipelined requests until the one in flight has been answered
+                conn.backlog += data
+                if len(conn.backlog) > self.max_buffer:
+                    self.pause(conn)
+                return
             try:
-                out.close()
+                events, consumed = conn.parser.feed(data)
             except Exception as e:
-                logging.error(f"Failed to close channel: {e}")
-            if out in self.input_list:
-                self.input_list.remove(out)
-            del self.channels[s]
+                logging.error("Failed to parse message: {}".format(e))
+                self.metrics.error('parse')
+                self.on_close(conn)
+                return
+            data = data[consumed:]
+            self.dispatch(conn, events)
+
+    def dispatch(self, conn, events):
+        is_client = conn.role == CLIENT
+        for event in events:
+            if conn.closed:
+                return
+            if event[0] == 'body':
+                conn.body_bytes += len(event[1])
+                peer = self.channels.get(conn)
+                client = conn if is_client else peer
+                if client is not None and client.hop is not None:
+                    client.hop.capture(event[1], is_client)
+                if peer is not None and (conn.forwarding or not is_client):
+                    upstream = peer if is_client else conn
+                    if upstream.exchange is not None:
+                        upstream.exchange.capture(event[1], is_client)
+                    if not is_client and conn.cached is not None:
+                        conn.cached.capture(event[1])
+                    if not is_client and peer.batch is not None:
+                        peer.batch.body += event[1]
+                    elif not is_client and conn.compressor is not None:
+                        self.send_body(peer, conn.compressor.compress(event[1]), conn.relay_chunked)
+                    else:
+                        self.send_body(peer, event[1], conn.relay_chunked)
+            elif event[0] == 'head':
+                if is_client:
+                    self.on_request(conn, event[1], event[2])
+                else:
+                    self.on_response(conn, event[1], event[2])
+            elif is_client:
+                self.on_request_end(conn)
+            else:
+                self.on_response_end(conn)
+
+    def on_writable(self, conn):
+        if conn.connecting:
+            err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                client = self.channels.pop(conn, None)
+                self.channels.pop(client, None)
+                self.close(conn)
+                conn.zotero.mark_down()
+                self.metrics.error('connect_failed')
+                if client is not None:
+                    self.on_connect_failed(client, os.strerror(err))
+                return
+            conn.connecting = False
+            conn.last_active = time.monotonic()
+            conn.zotero.mark_up()
+            self.metrics.observe('wps_zotero_upstream_connect_seconds', conn.last_active - conn.started)
+        self.flush(conn)
+
+    def send(self, conn, data):
+        if conn.closed:
+            return
+        conn.wbuf += data
+        if conn.request is not None:
+            conn.request += data
+            if len(conn.request) > RETRY_BUFFER_LIMIT:
+                conn.request = None
+        if not conn.connecting:
+            self.unflushed.add(conn)
+
+    def send_body(self, conn, data, chunked):
+        if chunked:
+            if not data:
+                return
+            self.send(conn, b'%x\r\n' % len(data))
+            self.send(conn, data)
+            self.send(conn, b'\r\n')
+        else:
+            self.send(conn, data)
+
+    def flush(self, conn):
+        if conn.closed:
+            return
+        if conn.wbuf:
             try:
-                del self.channels[out]
-            except KeyError:
-                pass
+                sent = conn.sock.send(conn.wbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except Exception as e:
+                logging.error("Failed to send data: {}".format(e))
+                self.metrics.error('send')
+                self.on_close(conn)
+                return
+            del conn.wbuf[:sent]
+            if sent:
+                conn.last_active = time.monotonic()
+
+        source = self.channels.get(conn)
+        if source is not None:
+            # Backpressure: stop reading what would pile up here until the buffer drains
+            if len(conn.wbuf) > self.max_buffer:
+                self.pause(source)
+            elif source.paused and len(conn.wbuf) <= self.max_buffer // 2:
+                self.resume(source)
+
+        read = 0 if conn.paused else selectors.EVENT_READ
+        if conn.wbuf:
+            self.watch(conn, read | selectors.EVENT_WRITE)
+            self.schedule(conn)
+        elif conn.closing:
+            self.close(conn)
+        else:
+            self.watch(conn, read)
+
+    def pause(self, conn):
+        """Stop reading from a connection, the data read so far has not been sent on"""
+        if conn.paused or conn.closed:
+            return
+        conn.paused = True
+        self.watch(conn, conn.events & ~selectors.EVENT_READ)
+        self.metrics.inc('wps_zotero_backpressure_pauses_total')
+
+    def resume(self, conn):
+        if not conn.paused or conn.closed:
+            return
+        conn.paused = False
+        self.watch(conn, conn.events | selectors.EVENT_READ)
+
+    def close_after_flush(self, conn):
+        conn.closing = True
+        if not conn.wbuf and not conn.connecting:
+            self.close(conn)
 
-        if s in self.input_list:
-            self.input_list.remove(s)
+    def close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.unflushed.discard(conn)
+        self.registry.discard(conn)
+        if conn.role == CLIENT and not self.registry.clients:
+            self.idle_since = time.monotonic()
+        if conn.events:
+            try:
+                self.selector.unregister(conn.sock)
+            except Exception as e:
+                logging.error(f"Failed to unregister socket: {e}")
         try:
-            s.close()
+            conn.sock.close()
         except Exception as e:
             logging.error(f"Failed to close socket: {e}")
-        logging.info("{} has disconnected".format(pname))
-
-    def on_recv(self, s, data):
-        # logging.debug('received data: {}'.format(data))
-        if data.startswith(b'POST /stopproxy'):
-            logging.info('received stopping command!')
-            if self.persistent:
-                logging.info('Persistent mode enabled: ignoring stop command.')
-                # Send 200 OK so the caller knows we received it, but we don't stop.
-                try:
-                    s.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
-                except Exception as e:
-                    logging.error(f"Failed to send response: {e}")
-                # We don't close socket immediately, or maybe we do?
-                # Usually HTTP is request-response.
+
+    def deadline(self, conn):
+        """When a connection times out in its current phase, None if it can wait indefinitely"""
+        timeouts = self.timeouts
+        if conn.connecting:
+            return conn.started + timeouts.connect
+        if conn.pooled:
+            return conn.last_active + conn.zotero.pool.idle_timeout
+        parser = conn.parser
+        if parser.state == HEAD and parser.head:
+            # From the start of the head, however slowly it trickles in
+            return conn.head_started + timeouts.header
+        # A peer that stopped reading what is sent to it times out as well
+        if parser.in_progress or conn.wbuf:
+            return conn.last_active + timeouts.read
+        if conn.role == CLIENT and not (conn.busy or conn.backlog):
+            # Idle keep-alive client, or one that will be refused
+            return conn.last_active + (timeouts.read if conn.rejected else timeouts.keep_alive)
+        # Waiting for Zotero, which may take as long as the user in a dialog
+        return None
+
+    def schedule(self, conn):
+        """Arm the timer of a connection for the deadline of its current phase.
+
+        Activity only moves deadlines later, so a timer is pushed on the heap only
+        when it would fire earlier than the one already armed. A timer firing early
+        is re-armed by check_timeouts(), superseded ones are skipped.
+        """
+        deadline = self.deadline(conn)
+        if deadline is not None and (conn.timer is None or deadline < conn.timer):
+            conn.timer = deadline
+            heapq.heappush(self.timers, (deadline, next(self.sequence), conn))
+
+    def check_timeouts(self):
+        now = time.monotonic()
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            deadline, _, conn = heapq.heappop(timers)
+            if conn.closed or conn.timer != deadline:
+                continue
+            conn.timer = None
+            deadline = self.deadline(conn)
+            if deadline is None:
+                continue
+            if deadline > now:
+                conn.timer = deadline
+                heapq.heappush(timers, (deadline, next(self.sequence), conn))
+                continue
+            self.on_timeout(conn)
+        if self.limiter is not None and now - self.swept > 1.0:
+            self.swept = now
+            self.limiter.evict(now)
+        if 0 < self.idle_exit < now - self.idle_since and not self.registry.clients:
+            logging.info('no client for {} seconds, exiting'.format(self.idle_exit))
+            self.stop()
+
+    def on_timeout(self, conn):
+        if conn.pooled:
+            conn.zotero.pool.discard(conn)
+            self.close(conn)
+            return
+        parser = conn.parser
+        if conn.role == CLIENT and not (conn.busy or conn.backlog or parser.in_progress or conn.wbuf):
+            self.on_close(conn)
+            return
+        logging.warning("{} timed out".format(conn.peer))
+        if conn.connecting:
+            client = self.channels.pop(conn, None)
+            self.channels.pop(client, None)
+            self.close(conn)
+            conn.zotero.mark_down()
+            self.metrics.error('connect_timeout')
+            if client is not None:
+                self.on_connect_failed(client, 'timed out')
+        else:
+            self.metrics.error('header_timeout' if parser.state == HEAD and parser.head else 'timeout')
+            self.on_close(conn)
+
+    def on_close(self, conn):
+        if conn.reused and conn.request is not None and not conn.parser.in_progress and conn in self.channels:
+            # A pooled connection went stale before answering, retry once on a fresh one
+            client = self.channels.pop(conn)
+            self.channels.pop(client, None)
+            self.close(conn)
+            logging.info('pooled connection to zotero was closed, retrying')
+            self.metrics.error('stale_pooled')
+            upstream = self.dial(client)
+            if upstream is not None:
+                self.occupy(upstream, conn.parser.bodyless)
+                upstream.exchange = conn.exchange
+                upstream.cached = conn.cached
+                self.channels[client] = upstream
+                self.channels[upstream] = client
+                self.send(upstream, conn.request)
+            return
+
+        if conn in self.channels:
+            out = self.channels.pop(conn)
+            self.channels.pop(out, None)
+            # An upstream connection that has not carried a request yet can still be pooled
+            unused = not (out.role == CLIENT or out.busy or out.connecting)
+            if unused and out.zotero.pool.release(out):
+                self.schedule(out)
             else:
-                s.close()
+                self.close_after_flush(out)
+
+        self.close(conn)
+        if conn.sampled:
+            log.debug("{} has disconnected".format(conn.peer))
+
+    def on_request(self, conn, request, headers):
+        conn.forwarding = False
+        if request.startswith('POST /stopproxy'):
+            if self.may_stop(conn.uid):
+                self.close(conn)
                 self.running = False
+                self.stop_requested = True
+            else:
+                # Send 200 OK so the caller knows we received it, but we don't stop.
+                self.send(conn, b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
             return
 
-        if s not in self.channels:
-            self.on_close(s)
+        conn.sampled = sample_log(self.log_sample)
+        if conn.sampled:
+            log.debug('message received on client {}: {}'.format(conn.peer, request))
+        conn.keep_alive = is_keep_alive(request, headers) and not conn.rejected
+        conn.chunked_ok = request.endswith('HTTP/1.1')
+        drop_hop_headers(headers)
+        conn.labels = (('method', request.split(' ')[0]), ('path', metric_path(request)))
+        conn.started = time.monotonic()
+        conn.body_bytes = 0
+
+        # The body of a request answered here is dropped, on_request_end closes the connection if it has to
+        data, status, conn.cache_key = self.answer_locally(request, headers, conn.keep_alive, conn.uid, conn.peer,
+                                                           conn.rejected, conn.started, conn.sampled)
+        if data is not None:
+            if status is not None:
+                self.count_response(conn, status)
+            self.send(conn, data)
             return
 
-        # Parse HEAD
-        head_raw, _, body_raw = data.partition(b"\r\n\r\n")
-        try:
-            request, headers = parse_head(head_raw)
-        except Exception as e:
-            logging.error("Failed to parse header: {}".format(e))
-            self.on_close(s)
+        if self.tracer is not None:
+            conn.hop = self.tracer.begin(request, conn.started, conn.zotero)
+
+        conn.encoding = None
+        if self.compression is not None:
+            conn.encoding = self.compression.negotiate(headers.get('Accept-Encoding'))
+        conn.batch = None
+        if self.batching and conn.labels[1][1] == BATCH_PATH:
+            conn.batch = Batch(headers)
+            request = request.replace(BATCH_PATH, RESPOND_PATH, 1)
+
+        # Only requests that are forwarded get a connection to Zotero
+        conn.forwarding = True
+        upstream = self.open_upstream(conn)
+        if upstream is None:
+            return
+        conn.relay_chunked = conn.parser.chunked
+        self.occupy(upstream, request.startswith('HEAD '))
+
+        # Forwarding request to Zotero
+        self.send(upstream, upstream_request_head(request, headers, self.pooling, upstream.zotero.port))
+        if self.recorder is not None:
+            upstream.exchange = self.recorder.begin(request, headers, conn.started)
+
+    def occupy(self, upstream, bodyless):
+        """Mark an upstream connection as carrying a request, which is kept to be retried"""
+        upstream.busy = True
+        # The response to a HEAD request has no body whatever its headers say
+        upstream.parser.bodyless = bodyless
+        upstream.request = bytearray()
+
+    def on_request_end(self, conn):
+        if not conn.forwarding:
+            if not (conn.keep_alive or conn.closing):
+                self.close_after_flush(conn)
+            return
+        self.metrics.observe('wps_zotero_request_body_bytes', conn.body_bytes, buckets=SIZE_BUCKETS)
+        if conn.hop is not None:
+            conn.hop.forwarded = time.monotonic()
+        upstream = self.channels.get(conn)
+        if upstream is not None and conn.relay_chunked:
+            self.send(upstream, b'0\r\n\r\n')
+        if upstream is not None and upstream.exchange is not None:
+            upstream.exchange.forwarded = time.monotonic()
+        # Wait for the response before reading the next request
+        conn.busy = True
+
+    def on_response(self, conn, status, headers):
+        client = self.channels.get(conn)
+        if client is None:
+            self.close(conn)
             return
 
+        if client.sampled:
+            log.debug('message received from zotero for {}: {}'.format(client.peer, status))
+        if conn.exchange is not None:
+            conn.exchange.respond(status, headers)
+        conn.cached = None
+        if client.cache_key is not None and not conn.parser.bodyless:
+            conn.cached = self.cache.begin(client.cache_key, status, headers, time.monotonic())
+        conn.request = None
+        conn.labels = (('status', status.split(' ')[1] if ' ' in status else ''),)
+        conn.body_bytes = 0
+        conn.reusable = conn.parser.delimited and is_keep_alive(status, headers)
+        conn.relay_chunked = conn.parser.chunked
+        if client.batch is not None:
+            # Read whole, see on_response_end
+            client.batch.status = status
+            conn.relay_chunked = False
+            return
+        conn.compressor = None
+        if client.encoding is not None and not conn.parser.bodyless and self.compression.applies(status, headers):
+            conn.compressor = self.compression.start(client.encoding, headers)
+            if client.chunked_ok:
+                headers['Transfer-Encoding'] = 'chunked'
+                conn.relay_chunked = True
+            else:
+                # HTTP/1.0 clients read the encoded body until the connection closes
+                headers.pop('Transfer-Encoding')
+                conn.relay_chunked = False
+                client.keep_alive = False
+        elif not conn.parser.delimited:
+            if client.keep_alive and client.chunked_ok:
+                # A response that ends with the connection is re-framed as chunks
+                headers['Transfer-Encoding'] = 'chunked'
+                conn.relay_chunked = True
+            else:
+                client.keep_alive = False
+
+        self.announce_batching(headers, client.labels[1][1])
+        self.send(client, client_response_head(status, headers, client.keep_alive))
+
+    def count_response(self, client, status):
+        self.metrics.inc('wps_zotero_requests_total', client.labels + (('status', status),))
+        self.metrics.observe('wps_zotero_request_duration_seconds', time.monotonic() - client.started,
+                             client.labels[1:])
+        if client.hop is not None:
+            self.tracer.end(client.hop, status)
+            client.hop = None
+
+    def acknowledge(self, conn, client):
+        """Answer a void command of a batch with null"""
+        self.metrics.inc('wps_zotero_batched_commands_total')
+        if not conn.reusable:
+            del self.channels[conn]
+            del self.channels[client]
+            self.close(conn)
+            conn = self.open_upstream(client)
+            if conn is None:
+                return
+            conn.busy = True
+        conn.request = bytearray()
+        self.send(conn, client.batch.ack_request())
+        if self.recorder is not None:
+            conn.exchange = self.recorder.begin('POST {} HTTP/1.1'.format(RESPOND_PATH), client.batch.headers,
+                                                time.monotonic(), b'null')
+
+    def on_response_end(self, conn):
+        client = self.channels.get(conn)
+        if client is None:
+            self.close(conn)
+            return
+        if conn.exchange is not None:
+            self.recorder.finish(conn.exchange)
+            conn.exchange = None
+        if conn.cached is not None:
+            self.cache.store(conn.cached, time.monotonic())
+            conn.cached = None
+        if client.batch is not None and client.batch.add():
+            self.acknowledge(conn, client)
+            return
+        del self.channels[conn]
+        del self.channels[client]
+
+        if client.batch is not None:
+            self.send(client, client.batch.response(client.keep_alive, self.compression, client.encoding))
+            if client.hop is not None:
+                client.hop.command = client.batch.last_command
+            client.batch = None
+        else:
+            if conn.compressor is not None:
+                self.send_body(client, conn.compressor.finish(), conn.relay_chunked)
+                conn.compressor = None
+            if conn.relay_chunked:
+                self.send(client, b'0\r\n\r\n')
+        self.count_response(client, conn.labels[0][1])
+        self.metrics.observe('wps_zotero_response_body_bytes', conn.body_bytes, buckets=SIZE_BUCKETS)
+
+        conn.busy = False
+        # Pooled connections are watched for Zotero closing them
+        self.resume(conn)
+        # Release the upstream connection first so that the next request can reuse it
+        if conn.reusable and conn.zotero.pool.release(conn):
+            self.schedule(conn)
+        else:
+            self.close(conn)
+
+        client.busy = False
+        self.resume(client)
+        client.last_active = time.monotonic()
+        if not client.keep_alive:
+            self.close_after_flush(client)
+        elif client.backlog:
+            backlog = bytes(client.backlog)
+            client.backlog.clear()
+            client.head_started = client.last_active
+            self.process(client, memoryview(backlog))
+        self.schedule(client)
+
+
+class AsyncUpstream:
+    """A pooled connection to Zotero for AsyncProxyServer."""
+
+    def __init__(self, reader, writer, zotero):
+        self.reader = reader
+        self.writer = writer
+        self.zotero = zotero
+        self.last_active = time.monotonic()
+        self.request = None
+        self.reused = False
+        self.pooled = False
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncUpstreamPool(UpstreamPool):
+
+    def is_healthy(self, conn):
+        return not (conn.reader.at_eof() or conn.writer.is_closing())
+
+
+class AsyncMessageReader:
+    """Read HTTP messages from an asyncio stream with MessageParser."""
+
+    def __init__(self, reader, is_request):
+        self.reader = reader
+        self.parser = MessageParser(is_request)
+        self.leftover = b''
+
+    async def read(self, timeout):
+        data = self.leftover
+        self.leftover = b''
+        if not data:
+            data = await asyncio.wait_for(self.reader.read(BUFSIZE), timeout)
+        return data
+
+    async def events(self, first_timeout=None, timeouts=None):
+        """Yield the events of the next message, nothing if the stream ends between messages"""
+        timeouts = timeouts or Timeouts()
+        timeout = first_timeout
+        head_deadline = None
+        while True:
+            data = await self.read(timeout)
+            if not data:
+                events = self.parser.eof()
+                if events is None:
+                    raise ConnectionError('closed in the middle of a message')
+                for event in events:
+                    yield event
+                return
+            events, consumed = self.parser.feed(data)
+            self.leftover = data[consumed:]
+            for event in events:
+                yield event
+                if event[0] == 'end':
+                    return
+            if self.parser.state == HEAD:
+                # From the start of the head, however slowly it trickles in
+                if head_deadline is None:
+                    head_deadline = time.monotonic() + timeouts.header
+                timeout = max(0.0, head_deadline - time.monotonic())
+            else:
+                timeout = timeouts.read
+
+
+def frame_body(data, chunked):
+    if chunked:
+        return b'%x\r\n%s\r\n' % (len(data), data) if data else b''
+    return data
+
+
+class AsyncProxyServer(BaseProxyServer):
+    """ProxyServer on asyncio streams, picks up uvloop when it is installed."""
+
+    pool_class = AsyncUpstreamPool
+
+    def __init__(self, *args, **kwargs):
+        global asyncio
+        import asyncio
+        # Requests being forwarded
+        self.active = 0
+        # Client connections open
+        self.connections = 0
+        super().__init__(*args, **kwargs)
+        self.loop = None
+
+    def active_channels(self):
+        return self.active
+
+    def client_connections(self):
+        return self.connections
+
+    def run(self):
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            loop_name = 'uvloop'
+        except ImportError:
+            loop_name = 'asyncio'
+        mode = "persistent" if self.persistent else "normal"
+        print(f"Proxy server running on {self.port} (mode: {mode}, engine: {loop_name})...")
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Stopping proxy server...")
+
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        servers = [await asyncio.start_server(self.on_accept, sock=listener) for listener in self.listeners]
+        evictor = asyncio.ensure_future(self.evict_idle())
+        if self.prober is not None:
+            self.prober.start()
+        if not self.stopping:
+            await self.stopped.wait()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        evictor.cancel()
+        if self.prober is not None:
+            self.prober.stop()
+        for zotero in self.router.instances.values():
+            for conn in zotero.pool.idle:
+                conn.close()
+        self.running = False
+
+    def stop(self):
+        self.stopping = True
+        if self.loop is not None:
+            # Safe from signal handlers
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def evict_idle(self):
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for conn in self.router.evict(now):
+                conn.close()
+            if self.limiter is not None:
+                self.limiter.evict(now)
+            if 0 < self.idle_exit < now - self.idle_since and not self.connections:
+                logging.info('no client for {} seconds, exiting'.format(self.idle_exit))
+                self.stop()
+
+    async def on_accept(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family == AF_UNIX:
+            peer = peer or self.unix_path
+        elif sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # drain() waits while more than this is queued for a slow client
+        writer.transport.set_write_buffer_limits(high=self.max_buffer)
+        uid = self.router.client_uid(sock)
+        rejected = 0 < self.max_connections <= self.connections
+        self.connections += 1
+        sampled = sample_log(self.log_sample)
+        if sampled:
+            log.debug("{} has connected".format(peer))
+        messages = AsyncMessageReader(reader, is_request=True)
         try:
-            peer_name = s.getpeername()
+            keep_alive = True
+            while keep_alive:
+                timeouts = self.timeouts
+                events = messages.events(timeouts.read if rejected else timeouts.keep_alive, timeouts)
+                head = None
+                async for event in events:
+                    head = event
+                    break
+                if head is None:
+                    break
+                keep_alive = await self.on_request(peer, head[1], head[2], events, messages.parser, writer, uid,
+                                                   rejected)
+                await writer.drain()
+        except asyncio.CancelledError:
+            # The server is shutting down, the connection is closed below like the selectors engine's
+            pass
+        except asyncio.TimeoutError:
+            logging.warning("{} timed out".format(peer))
+            self.metrics.error('timeout')
         except Exception as e:
-            logging.error(f"Failed to get peer name: {e}")
-            peer_name = None
-
-        if peer_name in self.clients:
-            # Preflight responses
-            logging.info('message received on client {}'.format(peer_name))
-            if data.startswith(b'OPTIONS') and get_header(headers, 'Origin') and get_header(headers, 'Access-Control-Request-Method'):
-                for k,v in PREFLIGHT_HEADERS.items():
-                    headers[k] = v
-
-                response_headers = []
-                for k,v in headers.items():
-                    response_headers.append(f"{k}: {v}")
-
-                # Preflight response
-                data = ('HTTP/1.1 200 OK\r\n' + '\r\n'.join(response_headers) + '\r\n\r\n').encode('utf8') + body_raw
-                try:
-                    s.sendall(data)
-                except Exception as e:
-                    logging.error(f"Failed to send preflight response: {e}")
-                logging.info('responded to a preflight request')
-                return
+            logging.error("Error on client {}: {}".format(peer, e))
+            if isinstance(e, ValueError):
+                self.metrics.error('parse')
+            elif isinstance(e, (ConnectionError, asyncio.IncompleteReadError)):
+                self.metrics.error('closed')
+            else:
+                self.metrics.error('other')
+        finally:
+            writer.close()
+            self.connections -= 1
+            if not self.connections:
+                self.idle_since = time.monotonic()
+        if sampled:
+            log.debug("{} has disconnected".format(peer))
+
+    async def on_request(self, peer, request, headers, events, parser, writer, uid=None, rejected=False):
+        """Answer one request, return whether the client connection stays open"""
+        if request.startswith('POST /stopproxy'):
+            if not self.may_stop(uid):
+                # Send 200 OK so the caller knows we received it, but we don't stop.
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+                return True
+            self.stop_requested = True
+            self.stop()
+            return False
 
-            # Forwarding request to Zotero
-            headers['Host'] = '127.0.0.1:{}'.format(ZOTERO_PORT)
+        sampled = sample_log(self.log_sample)
+        if sampled:
+            log.debug('message received on client {}: {}'.format(peer, request))
+        keep_alive = is_keep_alive(request, headers) and not rejected
+        chunked_ok = request.endswith('HTTP/1.1')
+        drop_hop_headers(headers)
+        labels = (('method', request.split(' ')[0]), ('path', metric_path(request)))
+        started = time.monotonic()
 
-            # Force close connection so we don't have to deal with Keep-Alive
-            headers['Connection'] = 'close'
+        data, status, cache_key = self.answer_locally(request, headers, keep_alive, uid, peer, rejected, started,
+                                                      sampled)
+        if data is not None:
+            async for _ in events:
+                pass
+            writer.write(data)
+            if status is not None:
+                self.count_response(labels, status, started)
+            return keep_alive
+
+        self.active += 1
+        try:
+            return await self.forward(peer, request, headers, events, parser, writer, keep_alive, chunked_ok, sampled,
+                                      uid, cache_key)
+        finally:
+            self.active -= 1
+
+    async def forward(self, peer, request, headers, events, parser, writer, keep_alive, chunked_ok, sampled,
+                      uid=None, cache_key=None):
+        """Forward a request to Zotero and relay the response, return whether the client connection stays open"""
+        labels = (('method', request.split(' ')[0]), ('path', metric_path(request)))
+        started = time.monotonic()
+        zotero = self.router.route(uid)
+        hop = self.tracer.begin(request, started, zotero) if self.tracer is not None else None
+        encoding = None
+        if self.compression is not None:
+            encoding = self.compression.negotiate(headers.get('Accept-Encoding'))
+        batch = None
+        if self.batching and labels[1][1] == BATCH_PATH:
+            batch = Batch(headers)
+            request = request.replace(BATCH_PATH, RESPOND_PATH, 1)
+        if zotero is None:
+            logging.warning("No Zotero port for the user of {} (uid {})".format(peer, uid))
+            self.metrics.error('unmapped_user')
+            async for _ in events:
+                pass
+            writer.write(USER_NOT_MAPPED)
+            self.count_response(labels, '403', started, hop)
+            return False
+        upstream = await self.open_upstream(zotero)
+        if upstream is None:
+            logging.warning("Cannot connect to Zotero, is the app started?")
+            # Read the rest of the request, closing with data unread would reset the connection
+            async for _ in events:
+                pass
+            writer.write(ZOTERO_NOT_RUNNING)
+            self.count_response(labels, '503', started, hop)
+            return False
 
-            # Reconstruct headers
-            header_lines = []
-            for k,v in headers.items():
-                header_lines.append(f"{k}: {v}")
+        # Forwarding request to Zotero
+        upstream.request = bytearray()
+        self.send(upstream, upstream_request_head(request, headers, self.pooling, upstream.zotero.port))
+        exchange = self.recorder.begin(request, headers, started) if self.recorder is not None else None
+        body_bytes = 0
+        async for event in events:
+            if event[0] == 'body':
+                body_bytes += len(event[1])
+                if hop is not None:
+                    hop.capture(event[1], True)
+                if exchange is not None:
+                    exchange.capture(event[1], True)
+                self.send(upstream, frame_body(event[1], parser.chunked))
+                await upstream.writer.drain()
+        if parser.chunked:
+            self.send(upstream, b'0\r\n\r\n')
+        self.metrics.observe('wps_zotero_request_body_bytes', body_bytes, buckets=SIZE_BUCKETS)
+        if hop is not None:
+            hop.forwarded = time.monotonic()
+        if exchange is not None:
+            exchange.forwarded = time.monotonic()
 
-            data = (request + '\r\n' + '\r\n'.join(header_lines) + '\r\n\r\n').encode('utf8') + body_raw
+        bodyless = request.startswith('HEAD ')
+        try:
+            response, events, (_, status, headers) = await self.read_response(upstream, bodyless)
+        except (ConnectionError, OSError):
+            upstream.close()
+            if not upstream.reused or upstream.request is None:
+                raise
+            # A pooled connection went stale before answering, retry once on a fresh one
+            logging.info('pooled connection to zotero was closed, retrying')
+            self.metrics.error('stale_pooled')
+            retry = await self.open_upstream(zotero, fresh=True)
+            if retry is None:
+                raise
+            retry.writer.write(upstream.request)
+            upstream = retry
+            response, events, (_, status, headers) = await self.read_response(upstream, bodyless)
 
+        if sampled:
+            log.debug('message received from zotero for {}: {}'.format(peer, status))
+        if exchange is not None:
+            exchange.respond(status, headers)
+        cached = None
+        if cache_key is not None and not bodyless:
+            cached = self.cache.begin(cache_key, status, headers, time.monotonic())
+        upstream.request = None
+        reusable = response.parser.delimited and is_keep_alive(status, headers)
+        body_bytes = 0
+        if batch is not None:
+            upstream, reusable = await self.drive_batch(batch, upstream, status, events, reusable, exchange)
+            status = batch.status
+            writer.write(batch.response(keep_alive, self.compression, encoding))
+            if hop is not None:
+                hop.command = batch.last_command
         else:
-            logging.info('message received from zotero')
-            # CORS
-            headers['Access-Control-Allow-Origin'] = '*'
+            relay_chunked = response.parser.chunked
+            compressor = None
+            if encoding is not None and not bodyless and self.compression.applies(status, headers):
+                compressor = self.compression.start(encoding, headers)
+                if chunked_ok:
+                    headers['Transfer-Encoding'] = 'chunked'
+                    relay_chunked = True
+                else:
+                    # HTTP/1.0 clients read the encoded body until the connection closes
+                    headers.pop('Transfer-Encoding')
+                    relay_chunked = False
+                    keep_alive = False
+            elif not response.parser.delimited:
+                if keep_alive and chunked_ok:
+                    # A response that ends with the connection is re-framed as chunks
+                    headers['Transfer-Encoding'] = 'chunked'
+                    relay_chunked = True
+                else:
+                    keep_alive = False
+
+            self.announce_batching(headers, labels[1][1])
+            writer.write(client_response_head(status, headers, keep_alive))
+            async for event in events:
+                if event[0] == 'body':
+                    body_bytes += len(event[1])
+                    if hop is not None:
+                        hop.capture(event[1], False)
+                    if exchange is not None:
+                        exchange.capture(event[1], False)
+                    if cached is not None:
+                        cached.capture(event[1])
+                    data = event[1] if compressor is None else compressor.compress(event[1])
+                    writer.write(frame_body(data, relay_chunked))
+                    await writer.drain()
+            if compressor is not None:
+                writer.write(frame_body(compressor.finish(), relay_chunked))
+            if relay_chunked:
+                writer.write(b'0\r\n\r\n')
+            if exchange is not None:
+                self.recorder.finish(exchange)
+            if cached is not None:
+                self.cache.store(cached, time.monotonic())
+        self.count_response(labels, status.split(' ')[1] if ' ' in status else '', started, hop)
+        self.metrics.observe('wps_zotero_response_body_bytes', body_bytes, buckets=SIZE_BUCKETS)
+
+        if not (reusable and upstream.zotero.pool.release(upstream)):
+            upstream.close()
+        return keep_alive
 
-            header_lines = []
-            for k,v in headers.items():
-                header_lines.append(f"{k}: {v}")
+    async def drive_batch(self, batch, upstream, status, events, reusable, exchange=None):
+        """Acknowledge void commands until one needs WPS, return (upstream, reusable)"""
+        while True:
+            batch.status = status
+            async for event in events:
+                if event[0] == 'body':
+                    batch.body += event[1]
+                    if exchange is not None:
+                        exchange.capture(event[1], False)
+            if exchange is not None:
+                self.recorder.finish(exchange)
+            if not batch.add():
+                return upstream, reusable
+            self.metrics.inc('wps_zotero_batched_commands_total')
+            if not reusable:
+                upstream.close()
+                upstream = await self.open_upstream(upstream.zotero, fresh=True)
+                if upstream is None:
+                    raise ConnectionError('cannot connect to Zotero')
+            self.send(upstream, batch.ack_request())
+            if exchange is not None:
+                exchange = self.recorder.begin('POST {} HTTP/1.1'.format(RESPOND_PATH), batch.headers,
+                                               time.monotonic(), b'null')
+            response, events, (_, status, headers) = await self.read_response(upstream, False)
+            if exchange is not None:
+                exchange.respond(status, headers)
+            reusable = response.parser.delimited and is_keep_alive(status, headers)
 
-            data = (request + '\r\n' + '\r\n'.join(header_lines) + '\r\n\r\n').encode('utf8') + body_raw
+    def count_response(self, labels, status, started, hop=None):
+        self.metrics.inc('wps_zotero_requests_total', labels + (('status', status),))
+        self.metrics.observe('wps_zotero_request_duration_seconds', time.monotonic() - started, labels[1:])
+        if hop is not None:
+            self.tracer.end(hop, status)
 
+    def send(self, upstream, data):
+        upstream.writer.write(data)
+        if upstream.request is not None:
+            upstream.request += data
+            if len(upstream.request) > RETRY_BUFFER_LIMIT:
+                upstream.request = None
+
+    async def read_response(self, upstream, bodyless):
+        """Wait for the response head, return (reader, remaining events, head event)"""
+        response = AsyncMessageReader(upstream.reader, is_request=False)
+        response.parser.bodyless = bodyless
+        events = response.events(None, self.timeouts)
+        async for event in events:
+            return response, events, event
+        raise ConnectionError('closed before answering')
+
+    async def open_upstream(self, zotero, fresh=False):
+        if not fresh:
+            upstream, stale = zotero.pool.acquire()
+            for conn in stale:
+                conn.close()
+            if upstream is not None:
+                return upstream
+        if zotero.down:
+            zotero.expedite()
+            self.metrics.error('zotero_down')
+            return None
+        started = time.monotonic()
         try:
-            self.channels[s].send(data)
-            # logging.info('responded to {}'.format(self.channels[s].getpeername()))
-        except Exception as e:
-            logging.error("Failed to send data: {}".format(e))
-            self.on_close(s)
+            if zotero.path:
+                connect = asyncio.open_unix_connection(zotero.path)
+            else:
+                connect = asyncio.open_connection('127.0.0.1', zotero.port)
+            reader, writer = await asyncio.wait_for(connect, self.timeouts.connect)
+        except (OSError, asyncio.TimeoutError) as e:
+            zotero.mark_down()
+            self.metrics.error('connect_timeout' if isinstance(e, asyncio.TimeoutError) else 'connect_failed')
+            log.debug("Failed to connect to Zotero: {}".format(e))
+            return None
+        zotero.mark_up()
+        self.metrics.observe('wps_zotero_upstream_connect_seconds', time.monotonic() - started)
+        sock = writer.get_extra_info('socket')
+        if sock is not None and not zotero.path:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.transport.set_write_buffer_limits(high=self.max_buffer)
+        return AsyncUpstream(reader, writer, zotero)
+
+
+def run_worker(server):
+    """Body of a worker process, exits with 0 only when the proxy was told to stop"""
+    # Interrupts go to the supervisor, which stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    # Blocked by Supervisor.spawn() until now, see there
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+    # Each worker counts on its own, a scrape only sees the one that answers it
+    server.metrics.labels = (('worker', str(os.getpid())),)
+    server.run()
+    if server.tracer is not None:
+        server.tracer.close()
+    if server.recorder is not None:
+        server.recorder.close()
+    sys.exit(0 if server.stop_requested else 1)
+
+
+class Supervisor:
+    """Runs a server in forked worker processes sharing its listening sockets.
+
+    Workers that exit without having received the stop command are restarted.
+    When one of them receives it, all the others are stopped.
+    """
+
+    def __init__(self, server, workers):
+        import multiprocessing
+        self.server = server
+        self.workers = workers
+        self.context = multiprocessing.get_context('fork')
+        self.processes = []
+        self.running = False
+
+    def spawn(self):
+        process = self.context.Process(target=run_worker, args=(self.server,), daemon=True)
+        # A SIGTERM sent to the new process before it sets its own handler would run
+        # the supervisor's, keep it pending until then
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            process.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        process.started = time.monotonic()
+        return process
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        import multiprocessing.connection
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self.running = True
+        self.processes = [self.spawn() for _ in range(self.workers)]
+        print(f"Supervising {self.workers} workers...")
+        try:
+            while self.running:
+                multiprocessing.connection.wait([p.sentinel for p in self.processes], 1.0)
+                exited = [(i, p) for i, p in enumerate(self.processes) if not p.is_alive()]
+                stopped = [p for _, p in exited if p.exitcode == 0]
+                if stopped:
+                    logging.info('worker {} received the stop command, stopping all'.format(stopped[0].pid))
+                    break
+                for i, process in exited:
+                    logging.warning('worker {} exited with {}, restarting it'.format(process.pid, process.exitcode))
+                    if time.monotonic() - process.started < WORKER_RESTART_DELAY:
+                        # Do not spin if it cannot start at all
+                        time.sleep(WORKER_RESTART_DELAY)
+                    self.processes[i] = self.spawn()
+        except KeyboardInterrupt:
+            print("Stopping proxy server...")
+        finally:
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes:
+                process.join(SOCKET_TIMEOUT)
+                if process.is_alive():
+                    process.kill()
+
+
+ENGINES = {
+    'selectors': ProxyServer,
+    'asyncio': AsyncProxyServer,
+}
 
 
 def main(argv):
@@ -370,32 +3188,142 @@ def main(argv):
     else:
         logfile = os.environ['APPDATA'] + '\\kingsoft\\wps\\jsaddons\\wps-zotero-proxy.log'
 
-    # Rotate log if too big
-    if os.path.exists(logfile) and os.path.getsize(logfile) > 100 * 1024:
-        try:
-            os.remove(logfile)
-        except Exception as e:
-            logging.error(f"Failed to remove log file: {e}")
-
-    logging.basicConfig(filename=logfile,
-                        filemode='a',
-                        format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s: %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S',
-                        level=logging.INFO)
+    log_format = get_option(argv, '--log-format', 'text')
+    if log_format not in LOG_FORMATS:
+        print(f"Unknown log format {log_format}, expected one of: {', '.join(LOG_FORMATS)}")
+        return
+    # Fraction of requests whose debug messages are logged
+    log_sample = float(get_option(argv, '--log-sample', 0.0))
+    batching = '--batch' in argv
+    workers = int(get_option(argv, '--workers', 0))
+    if workers and os.name != 'posix':
+        print("--workers is only supported on Linux and macOS")
+        return
+    # Workers log through the supervisor, the only process writing the file
+    records = None
+    if workers:
+        import multiprocessing
+        records = multiprocessing.get_context('fork').Queue()
+    listener = setup_logging(logfile, log_format, logging.DEBUG if log_sample > 0 else logging.INFO, records)
+    # Registered first so that it runs last, after 'proxy stopped!' is logged
+    atexit.register(listener.stop)
 
     # Check for arguments
+    port = int(get_option(argv, '--port', PROXY_PORT))
+    unix_path = get_option(argv, '--unix')
+    if unix_path:
+        if AF_UNIX is None:
+            print("--unix is not supported on this platform")
+            return
+        unix_path = os.path.expanduser(unix_path)
     persistent = False
     if '--persistent' in argv:
         persistent = True
     elif len(argv) > 1 and argv[1] == 'kill':
-        stop_proxy()
+        stop_proxy(port, unix_path)
+        return
+    idle_exit = float(get_option(argv, '--idle-exit', IDLE_EXIT))
+    if idle_exit > 0 and workers:
+        print("--idle-exit cannot be combined with --workers")
+        return
+    listeners = activated_listeners()
+    listen_fd = get_option(argv, '--fd')
+    if listen_fd is not None:
+        listeners.append(inherit_listener(int(listen_fd)))
+
+    pool_size = int(get_option(argv, '--pool-size', POOL_MAX_SIZE))
+    tracer = None
+    trace_dir = get_option(argv, '--trace')
+    if trace_dir:
+        trace_format = get_option(argv, '--trace-format', 'chrome')
+        if trace_format not in TRACE_FORMATS:
+            print(f"Unknown trace format {trace_format}, expected one of: {', '.join(TRACE_FORMATS)}")
+            return
+        tracer = Tracer(os.path.expanduser(trace_dir), trace_format)
+    recorder = None
+    record_dir = get_option(argv, '--record')
+    if record_dir:
+        recorder = Recorder(os.path.expanduser(record_dir))
+    compression = None
+    if '--compress' in argv:
+        compress_level = int(get_option(argv, '--compress-level', COMPRESS_LEVEL))
+        if not 1 <= compress_level <= 11:
+            print(f"Invalid compression level {compress_level}, expected 1 to 9 (11 for brotli)")
+            return
+        compression = Compression(compress_level, int(get_option(argv, '--compress-min-size', COMPRESS_MIN_SIZE)))
+    cache = None
+    if '--cache' in argv:
+        ttls = dict(RESPONSE_CACHE_TTLS)
+        cache_ttls = get_option(argv, '--cache-ttl')
+        if cache_ttls:
+            try:
+                for item in cache_ttls.split(','):
+                    path, seconds = item.rsplit('=', 1)
+                    ttls[path.strip()] = float(seconds)
+            except ValueError:
+                print(f"Invalid --cache-ttl {cache_ttls}, expected PATH=SECONDS[,PATH=SECONDS...]")
+                return
+        cache = ResponseCache(ttls, int(get_option(argv, '--cache-size', RESPONSE_CACHE_SIZE)))
+    zotero_port = int(get_option(argv, '--zotero-port', ZOTERO_PORT))
+    zotero_path = get_option(argv, '--zotero-unix')
+    if zotero_path:
+        if AF_UNIX is None:
+            print("--zotero-unix is not supported on this platform")
+            return
+        zotero_path = os.path.expanduser(zotero_path)
+    unix_mode = int(get_option(argv, '--unix-mode', oct(UNIX_SOCKET_MODE)[2:]), 8)
+    try:
+        max_connections = number_option(argv, '--max-connections', MAX_CONNECTIONS)
+        rate_limit = number_option(argv, '--rate-limit', RATE_LIMIT, float)
+        rate_burst = number_option(argv, '--rate-burst', RATE_BURST)
+        timeouts = Timeouts(number_option(argv, '--connect-timeout', CONNECT_TIMEOUT, float, positive=True),
+                            number_option(argv, '--header-timeout', HEADER_TIMEOUT, float, positive=True),
+                            number_option(argv, '--read-timeout', READ_TIMEOUT, float, positive=True),
+                            number_option(argv, '--keep-alive-timeout', KEEP_ALIVE_TIMEOUT, float, positive=True))
+    except ValueError as e:
+        print(e)
+        return
+    max_buffer = int(get_option(argv, '--max-buffer', MAX_BUFFER))
+    probe_interval = float(get_option(argv, '--probe-interval', PROBE_INTERVAL))
+    limiter = None
+    if rate_limit > 0:
+        limiter = RateLimiter(rate_limit, rate_burst)
+    user_map = None
+    user_map_file = get_option(argv, '--user-map')
+    if user_map_file:
+        if not sys.platform.startswith('linux'):
+            print("--user-map is only supported on Linux")
+            return
+        try:
+            user_map = load_user_map(os.path.expanduser(user_map_file))
+        except (OSError, ValueError) as e:
+            print(f"Cannot read the user map: {e}")
+            return
+    engine = get_option(argv, '--engine', 'selectors')
+    if engine not in ENGINES:
+        print(f"Unknown engine {engine}, expected one of: {', '.join(ENGINES)}")
         return
 
     try:
-        server = ProxyServer('127.0.0.1', PROXY_PORT, persistent=persistent)
+        server = ENGINES[engine]('127.0.0.1', port, persistent=persistent, pool_size=pool_size,
+                                 tracer=tracer, log_sample=log_sample, batching=batching,
+                                 compression=compression, zotero_port=zotero_port, user_map=user_map,
+                                 unix_path=unix_path, unix_mode=unix_mode, zotero_path=zotero_path,
+                                 max_connections=max_connections, limiter=limiter, max_buffer=max_buffer,
+                                 timeouts=timeouts, recorder=recorder, listeners=listeners, idle_exit=idle_exit,
+                                 probe_interval=probe_interval, cache=cache)
         logging.info('proxy started!')
         atexit.register(lambda : logging.info('proxy stopped!'))
-        server.run()
+        if unix_path:
+            atexit.register(remove_unix_listener, unix_path)
+        if tracer is not None:
+            atexit.register(tracer.close)
+        if recorder is not None:
+            atexit.register(recorder.close)
+        if workers:
+            Supervisor(server, workers).run()
+        else:
+            server.run()
     except (KeyboardInterrupt, SystemExit):
         logging.info("Proxy stopped by user.")
     except Exception as e:
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Regression tests for proxy.py.
+
+Run from the repository root with `python -m unittest discover tests`.
+"""
+
+import http.client
+import os
+import socket
+import sys
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy  # noqa: E402
+
+
+class PathZotero(threading.Thread):
+    """Zotero stand-in answering every request with its path"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        index = 0
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(sock, index), daemon=True).start()
+            index += 1
+
+    def serve(self, sock, index):
+        with sock, sock.makefile('rb') as f:
+            try:
+                self.answer(sock, f, index)
+            except OSError:
+                pass
+
+    def answer(self, sock, f, index):
+        for count in range(1, 100):
+            line = f.readline()
+            if not line:
+                return
+            while f.readline() not in (b'\r\n', b''):
+                pass
+            method, path = line.split()[:2]
+            if not self.should_answer(index, count):
+                return
+            body = b'' if method == b'HEAD' else path
+            sock.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(path), body))
+
+    def should_answer(self, index, count):
+        """Whether to answer the count-th request of the index-th connection, or close it"""
+        return True
+
+    def close(self):
+        self.listener.close()
+
+
+class StaleZotero(PathZotero):
+    """PathZotero whose first connection goes stale once pooled
+
+    The connection dialed to retry the request lost on the stale one is only answered once release is set.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Set once the retried request arrived, and to let it be answered
+        self.holding = threading.Event()
+        self.release = threading.Event()
+
+    def should_answer(self, index, count):
+        if index == 0 and count == 2:
+            # Closed by Zotero while it was in the pool
+            return False
+        if index == 1:
+            self.holding.set()
+            self.release.wait(5)
+        return True
+
+    def close(self):
+        self.release.set()
+        super().close()
+
+
+def start(engine, zotero):
+    """Run a proxy server of the engine in a thread, forwarding to zotero, return it and its port"""
+    server = proxy.ENGINES[engine]('127.0.0.1', 0, zotero_port=zotero.port, probe_interval=0)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    return server, thread, server.listeners[0].getsockname()[1]
+
+
+class StalePoolRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.zotero = StaleZotero()
+        self.zotero.start()
+        self.server, self.thread, self.port = start('selectors', self.zotero)
+        # Pools the first connection to Zotero
+        self.assertEqual(self.request('GET', '/first'), (200, b'/first'))
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join(5)
+        self.zotero.close()
+
+    def connect(self):
+        client = http.client.HTTPConnection('127.0.0.1', self.port, timeout=3)
+        self.addCleanup(client.close)
+        return client
+
+    def request(self, method, path, client=None):
+        client = client or self.connect()
+        client.request(method, path)
+        response = client.getresponse()
+        return response.status, response.read()
+
+    def test_client_gone_before_retried_answer(self):
+        client = socket.create_connection(('127.0.0.1', self.port))
+        client.sendall(b'GET /lost HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+        self.assertTrue(self.zotero.holding.wait(3))
+        client.close()
+        time.sleep(0.2)
+        # Sent before Zotero answers /lost, which must not be relayed to this client
+        client = self.connect()
+        client.request('GET', '/next')
+        time.sleep(0.2)
+        self.zotero.release.set()
+        response = client.getresponse()
+        self.assertEqual((response.status, response.read()), (200, b'/next'))
+
+    def test_retried_head(self):
+        self.zotero.release.set()
+        client = self.connect()
+        self.assertEqual(self.request('HEAD', '/head', client), (200, b''))
+        # Answered once the proxy is done with the response to HEAD
+        self.assertEqual(self.request('GET', '/after', client), (200, b'/after'))
+
+
+class WindowsSocket(types.ModuleType):
+    """The socket module as proxy.py finds it on Windows, without AF_UNIX"""
+
+    def __getattr__(self, name):
+        if name == 'AF_UNIX':
+            raise AttributeError(name)
+        return getattr(socket, name)
+
+
+class NoUnixSocketTest(unittest.TestCase):
+    """Platforms without AF_UNIX, Windows among them"""
+
+    def setUp(self):
+        self.zotero = PathZotero()
+        self.zotero.start()
+        self.addCleanup(self.zotero.close)
+        for name, value in (('socket', WindowsSocket('socket')), ('AF_UNIX', None)):
+            patcher = mock.patch.object(proxy, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def forward(self, engine):
+        server, thread, port = start(engine, self.zotero)
+        try:
+            client = http.client.HTTPConnection('127.0.0.1', port, timeout=3)
+            client.request('GET', '/connector/ping')
+            response = client.getresponse()
+            self.assertEqual((response.status, response.read()), (200, b'/connector/ping'))
+            client.close()
+        finally:
+            server.stop()
+            thread.join(5)
+
+    def test_selectors(self):
+        self.forward('selectors')
+
+    def test_asyncio(self):
+        self.forward('asyncio')
+
+
+if __name__ == '__main__':
+    unittest.main()